@@ -0,0 +1,355 @@
+#!/usr/bin/python3
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+# Runs snap.py against local stand-in servers instead of the live sites, so
+# changes to the runner itself can be measured offline:
+#
+#     bench/benchmark.py                    # compare with bench/baseline.json
+#     bench/benchmark.py --update-baseline  # store this run as the baseline
+#
+# The servers serve synthetic CSV and JSON of a given size after a given
+# latency, and HTML pages whose elements appear after a given render delay.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SNAP = os.path.join(HERE, "..", "snap.py")
+BASELINE = os.path.join(HERE, "baseline.json")
+
+TOLERANCE = 0.2  # report metrics more than 20% worse than the baseline
+
+# A fake xymon client that appends each message it is sent to a file.
+FAKE_XYMON = """#!/bin/sh
+cat >> "$SNAP_BENCH_MESSAGES"
+printf '\\n\\n' >> "$SNAP_BENCH_MESSAGES"
+"""
+
+PAGE = """<!DOCTYPE html>
+<html>
+<body>
+<div id="root"></div>
+<script>
+setTimeout(function () {{
+    var root = document.getElementById("root");
+    for (var i = 0; i < {elements}; i++) {{
+        var span = document.createElement("span");
+        span.className = "item";
+        span.textContent = i;
+        root.appendChild(span);
+    }}
+}}, {delay_ms});
+</script>
+</body>
+</html>
+"""
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        time.sleep(float(query.get("latency", 0)))
+
+        if url.path == "/csv":
+            self.sendCsv(int(query.get("rows", 100)))
+        elif url.path == "/json":
+            self.sendJson(int(query.get("items", 100)))
+        elif url.path == "/page":
+            body = PAGE.format(
+                elements=int(query.get("elements", 100)),
+                delay_ms=int(float(query.get("render", 0)) * 1000),
+            )
+            self.sendBody(body.encode("utf-8"), "text/html")
+        elif url.path == "/url":
+            self.sendBody(b"ok", "text/plain")
+        else:
+            self.send_error(404)
+
+    def sendBody(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def sendChunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+    def startChunked(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    # Large bodies are generated as they are sent, like a real API would.
+    def sendCsv(self, rows):
+        self.startChunked("text/csv; charset=utf-8")
+        self.sendChunk(b"# Synthetic data for benchmarking\nid,lat,lon,value\n")
+        for start in range(0, rows, 1000):
+            lines = [
+                "{},64.5,-147.5,{}\n".format(i, i * 0.5)
+                for i in range(start, min(rows, start + 1000))
+            ]
+            self.sendChunk("".join(lines).encode("utf-8"))
+        self.sendChunk(b"")
+
+    def sendJson(self, items):
+        self.startChunked("application/json")
+        self.sendChunk(b'{"data": [')
+        for start in range(0, items, 1000):
+            values = [
+                '{{"id": {}, "value": {}}}'.format(i, i * 0.5)
+                for i in range(start, min(items, start + 1000))
+            ]
+            prefix = "," if start else ""
+            self.sendChunk((prefix + ",".join(values)).encode("utf-8"))
+        self.sendChunk(b"]}")
+        self.sendChunk(b"")
+
+
+def startServer():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# One test file per machine, each with the given number of tests of each type.
+def writeCatalog(config_dir, base, args):
+    for number in range(args.machines):
+        machine_tests = []
+
+        for i in range(args.csv):
+            machine_tests.append(
+                {
+                    "column": "webapp",
+                    "type": "csv",
+                    "url": "{}/csv?rows={}&latency={}&n={}.{}".format(
+                        base, args.rows, args.latency, number, i
+                    ),
+                    "text": "Synthetic CSV {}.".format(i),
+                    "full": True,
+                }
+            )
+
+        for i in range(args.json):
+            machine_tests.append(
+                {
+                    "column": "webapp",
+                    "type": "json",
+                    "url": "{}/json?items={}&latency={}&n={}.{}".format(
+                        base, args.rows, args.latency, number, i
+                    ),
+                    "text": "Synthetic JSON {}.".format(i),
+                    "required": ["data"],
+                }
+            )
+
+        for i in range(args.url):
+            machine_tests.append(
+                {
+                    "column": "webapp",
+                    "type": "url",
+                    "url": "{}/url?latency={}&n={}.{}".format(
+                        base, args.latency, number, i
+                    ),
+                    "text": "Synthetic URL {}.".format(i),
+                }
+            )
+
+        # Every check of a page shares one page load, as on the real sites.
+        for i in range(args.page_checks):
+            machine_tests.append(
+                {
+                    "column": "webapp",
+                    "type": "javascript",
+                    "url": "{}/page?elements={}&render={}&n={}".format(
+                        base, args.elements, args.render, number
+                    ),
+                    "javascript": (
+                        "return document.querySelectorAll('#root .item').length"
+                        " >= {}".format(args.elements)
+                    ),
+                    "text": "Synthetic page check {}.".format(i),
+                }
+            )
+
+        path = os.path.join(config_dir, "bench{}.local.json".format(number))
+        with open(path, "w") as test_file:
+            json.dump(machine_tests, test_file, indent=4)
+
+
+def readRecords(state_dir):
+    results_dir = os.path.join(state_dir, "snap-results")
+    records = []
+    for name in sorted(os.listdir(results_dir)):
+        with open(os.path.join(results_dir, name)) as results_file:
+            records.extend(json.loads(line) for line in results_file)
+    return records
+
+
+def summarize(records, run_time, peak_rss_mb, statuses):
+    metrics = {
+        "run_time": run_time,
+        "peak_rss_mb": peak_rss_mb,
+        "tests": len(records),
+        "passed": sum(1 for record in records if record["success"]),
+        "statuses": statuses,
+    }
+
+    for test_type in ("csv", "json", "url", "javascript"):
+        typed = [record for record in records if record["type"] == test_type]
+        if not typed:
+            continue
+
+        metrics[test_type + "_wall_total"] = sum(r["wall"] for r in typed)
+        metrics[test_type + "_wall_max"] = max(r["wall"] for r in typed)
+
+        for stage in ("ttfb", "server", "page_load", "wait", "script"):
+            values = [r[stage] for r in typed if stage in r]
+            if values:
+                metrics["{}_{}_mean".format(test_type, stage)] = sum(values) / len(
+                    values
+                )
+
+    return metrics
+
+
+def runBenchmark(args):
+    server = startServer()
+    base = "http://127.0.0.1:{}".format(server.server_address[1])
+    work_dir = tempfile.mkdtemp(prefix="snap-bench-")
+
+    try:
+        config_dir = os.path.join(work_dir, "tests.d")
+        state_dir = os.path.join(work_dir, "state")
+        os.makedirs(config_dir)
+        os.makedirs(state_dir)
+        writeCatalog(config_dir, base, args)
+
+        xymon = os.path.join(work_dir, "xymon")
+        with open(xymon, "w") as xymon_file:
+            xymon_file.write(FAKE_XYMON)
+        os.chmod(xymon, 0o755)
+
+        messages = os.path.join(work_dir, "messages")
+        env = dict(
+            os.environ,
+            XYMON=xymon,
+            XYMSRV="127.0.0.1",
+            SNAP_STATE_DIR=state_dir,
+            SNAP_BENCH_MESSAGES=messages,
+        )
+
+        start = time.time()
+        process = subprocess.Popen(
+            [sys.executable, SNAP, "--config", config_dir],
+            env=env,
+            stdout=subprocess.DEVNULL if args.quiet else None,
+        )
+        # ru_maxrss covers the largest process in the tree that was waited
+        # for, in KB on Linux.
+        status, rusage = os.wait4(process.pid, 0)[1:]
+        run_time = time.time() - start
+
+        if os.waitstatus_to_exitcode(status) != 0:
+            sys.exit("snap.py exited with status {}".format(status))
+
+        statuses = 0
+        if os.path.exists(messages):
+            with open(messages) as messages_file:
+                statuses = sum(1 for line in messages_file if line.startswith("status"))
+
+        return summarize(
+            readRecords(state_dir), run_time, rusage.ru_maxrss // 1024, statuses
+        )
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# Lower is better for every timing and memory metric. Counts are only
+# reported if they changed.
+def compareWithBaseline(metrics, baseline):
+    regressions = []
+
+    for name, value in sorted(metrics.items()):
+        if name not in baseline:
+            continue
+
+        old = baseline[name]
+        if name in ("tests", "passed", "statuses"):
+            if value != old:
+                regressions.append("{}: {} (baseline {})".format(name, value, old))
+        elif old > 0 and value > old * (1 + TOLERANCE):
+            regressions.append(
+                "{}: {:.3f} (baseline {:.3f}, +{:.0%})".format(
+                    name, value, old, value / old - 1
+                )
+            )
+
+    return regressions
+
+
+parser = argparse.ArgumentParser(description="Benchmark snap.py offline.")
+parser.add_argument("--machines", type=int, default=5, help="test files to run")
+parser.add_argument("--csv", type=int, default=4, help="csv tests per machine")
+parser.add_argument("--json", type=int, default=4, help="json tests per machine")
+parser.add_argument("--url", type=int, default=4, help="url tests per machine")
+parser.add_argument(
+    "--page-checks",
+    type=int,
+    default=4,
+    help="javascript tests per machine, all on one page (0 skips the browser)",
+)
+parser.add_argument("--rows", type=int, default=10000, help="CSV rows/JSON items")
+parser.add_argument("--latency", type=float, default=0.2, help="server latency (s)")
+parser.add_argument("--elements", type=int, default=500, help="elements per page")
+parser.add_argument("--render", type=float, default=1.0, help="page render delay (s)")
+parser.add_argument(
+    "--update-baseline", action="store_true", help="save this run as the baseline"
+)
+parser.add_argument("--quiet", action="store_true", help="hide snap.py's output")
+args = parser.parse_args()
+
+metrics = runBenchmark(args)
+
+for name, value in sorted(metrics.items()):
+    if isinstance(value, float):
+        print("{:<28} {:10.3f}".format(name, value))
+    else:
+        print("{:<28} {:10}".format(name, value))
+
+if args.update_baseline:
+    with open(BASELINE, "w") as baseline_file:
+        json.dump(metrics, baseline_file, indent=4, sort_keys=True)
+        baseline_file.write("\n")
+    print("Baseline saved to " + BASELINE)
+elif os.path.exists(BASELINE):
+    with open(BASELINE) as baseline_file:
+        regressions = compareWithBaseline(metrics, json.load(baseline_file))
+
+    if regressions:
+        print("Worse than the baseline:")
+        for regression in regressions:
+            print("  " + regression)
+        sys.exit(1)
+
+    print("No regressions against the baseline.")
+else:
+    print("No baseline yet; run with --update-baseline to save one.")
@@ -1,1067 +1,2774 @@
 #!/usr/bin/python3
+import argparse
+import collections
 import csv
 import os
 import subprocess
 import random
 import re
 import requests
+import signal
+import socket
 import time
 import sys
 import fcntl
+import hashlib
+import io
+import heapq
+import itertools
+import json
+import sqlite3
+import threading
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from urllib.parse import quote, urlparse
 
-from selenium import webdriver
-from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
-from selenium.webdriver.common.by import By
-from selenium.webdriver.firefox.options import Options
-from selenium.webdriver.common.action_chains import ActionChains
 
 from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from urllib3.util.retry import Retry
 
+# ijson lets json tests validate the body as it streams in. Without it, the
+# whole body is parsed at once and checked the same way.
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
-# Prevent overlapping runs of the script with a lock file.
-LOCKFILE = "/tmp/snap.py.lock"
-lock_fp = open(LOCKFILE, "w")
+# PyYAML is only needed for tests written in YAML files.
 try:
-    fcntl.flock(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
-except IOError:
-    sys.exit(0)  # another instance running — exit quietly
+    import yaml
+except ImportError:
+    yaml = None
+
+
+# Where the lock file, logs, results and cache go. Set SNAP_STATE_DIR to keep
+# a separate copy, for example when benchmarking.
+STATE_DIR = os.getenv("SNAP_STATE_DIR", "/tmp")
+LOCKFILE = os.path.join(STATE_DIR, "snap.py.lock")
 
 xymon = os.getenv("XYMON")
 xymsrv = os.getenv("XYMSRV")
 
+# How to deliver the combined status message: "xymon" pipes it to the $XYMON
+# client, "tcp" connects to the Xymon daemon at $XYMSRV directly.
+XYMON_TRANSPORT = "xymon"
+XYMON_PORT = 1984
+
 DEFAULT_REQUEST_TIMEOUT = 600  # 10 minutes max per HTTP request
+PAGE_LOAD_TIMEOUT = 900  # 15 minutes max per page load
+RUN_DEADLINE = 18 * 60  # a run gives up on unfinished tests after this
+RUN_DEADLINE_GRACE = 30  # time allowed for tests to wind down at the deadline
+STATUS_CHECK_INTERVAL = 5  # seconds between checks for columns that finished
+PROGRESS_INTERVAL = 5 * 60  # "in progress" statuses for columns still running
+HTTP_WORKERS = 16  # csv, json and url tests run at the same time
+HTTP_WORKERS_PER_HOST = 4  # ...but no more than this many against one host
+HTTP_HOSTS = 32  # hosts to keep idle keep-alive connections open to
+DNS_CACHE_TTL = 5 * 60  # seconds to reuse a DNS lookup
+CONNECT_TIMEOUT = 15  # seconds to wait for a TCP connection to be accepted
+HTTP_RETRIES = 2  # retries after a failed connection or a 502, 503 or 504
+HTTP_BACKOFF = 1  # seconds before the first retry, doubling after that
+HOST_FAILURES = 3  # consecutive connection failures before a host is "down"
+HOST_COOLDOWN = 5 * 60  # seconds before a down host is tried again
+
+# Hosts that get more (or fewer) concurrent requests, and pooled keep-alive
+# connections, than HTTP_WORKERS_PER_HOST.
+HOST_LIMITS = {
+    "earthmaps.io": 8,
+}
+POLL_INTERVAL = 2  # seconds between re-runs of a pending JavaScript test
+BROWSER_WORKERS = 4  # headless Firefox instances running javascript tests
+BROWSER_MEMORY_MB = 1024  # memory to allow for each Firefox instance
+BROWSER_MAX_PAGES = 40  # restart a Firefox after it has loaded this many pages
+RESOURCE_BUFFER_SIZE = 2000  # resource timings a page keeps (browser default 250)
+SLOWEST_RESOURCES = 10  # slowest requests of each page kept with its results
+RESULTS_DIR = os.path.join(STATE_DIR, "snap-results")  # timings, one file per run
+RESULTS_KEEP = 500  # number of runs to keep in RESULTS_DIR
+SLOWEST_REPORTED = 10  # slowest tests listed in the log after each run
+DATA_SUFFIX = "-timing"  # data messages go to the "<column>-timing" test
+CONFIG_COLUMN = "config"  # problems of a test file without a single valid test
+CACHE_DIR = os.path.join(STATE_DIR, "snap-cache")  # validators of passed responses
+CACHE_MAX_ENTRIES = 1000  # least recently used entries are evicted past this
+CACHE_MAX_AGE = 24 * 60 * 60  # fully re-check a cached response this often
+HISTORY_DB = os.path.join(STATE_DIR, "snap-history.sqlite")  # every test result
+HISTORY_RAW_DAYS = 14  # keep each result this long, then only hourly summaries
+HISTORY_KEEP_DAYS = 365  # keep hourly summaries this long
+SLOW_WINDOW = 7 * 24 * 60 * 60  # past results a test's usual p95 comes from
+SLOW_MIN_RESULTS = 20  # passes needed in the window before a test can be slow
+SLOW_FACTOR = 3  # a pass this many times slower than its usual p95 is "slow"
+SLOW_MIN_EXCESS = 1  # ...if it is also at least this many seconds slower
+SLOW_REFRESH = 10 * 60  # how often the daemon reloads every test's p95
+TRACE_DIR = os.path.join(STATE_DIR, "snap-traces")  # traces of slow pages (--trace)
+TRACE_MAX_AGE = 7 * 24 * 60 * 60  # traces older than this are removed
+TRACE_MAX_MB = 500  # oldest traces are removed once there are more than this
+TRACE_BUFFER_MB = 64  # memory for the Firefox profiler's samples while tracing
+
+# In daemon mode, how often (in seconds) each type of test runs unless the
+# test sets its own "interval". JavaScript tests that share a page load run
+# as often as the most frequent of them.
+DAEMON_INTERVALS = {
+    "url": 60,
+    "csv": 5 * 60,
+    "json": 5 * 60,
+    "javascript": 30 * 60,
+}
+
+# Tests are read from one file per machine in this directory, named after the
+# machine: tests.d/example.org.json (or .yaml).
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests.d")
+CONFIG_CHECK_INTERVAL = 30  # seconds between checks for changed files (daemon)
+
+# What the browser doesn't download unless a test (or its machine's file) sets
+# its own "block" list: "fonts", "images", "trackers", or host name patterns
+# such as "*.google-analytics.com". Images stay allowed by default because
+# map checks count loaded Leaflet tiles, which are images.
+DEFAULT_BLOCK = [
+    "fonts",
+    "trackers",
+    "*.google-analytics.com",
+    "*.googletagmanager.com",
+    "*.doubleclick.net",
+]
+
+COORD_SEED = "snap"  # seed for the pools of points used by lat/lon tests
+COORD_POOL_SIZE = 24  # points in each pool
+ROTATION_PERIOD = 20 * 60  # move on to the next point this often
+
+# Connection setup time for the requests made by the current thread, split
+# into DNS lookup, TCP connect and TLS handshake, so fetch() can tell how
+# much of a response's time was spent before the server saw the request.
+transport = threading.local()
+
+
+def resetTransportTimings():
+    transport.dns = 0.0
+    transport.tcp = 0.0
+    transport.setup = 0.0
+
+
+def addTransportTiming(name, start):
+    setattr(transport, name, getattr(transport, name, 0.0) + time.time() - start)
+
+
+class TimedConnection:
+    def _new_conn(self):
+        start = time.time()
+        try:
+            return super()._new_conn()
+        finally:
+            addTransportTiming("tcp", start)
+
+    def connect(self):
+        start = time.time()
+        try:
+            super().connect()
+        finally:
+            addTransportTiming("setup", start)
+
+
+class TimedHTTPConnection(TimedConnection, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnection, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+
 
+# Most tests go to a handful of hosts, so remember their addresses instead
+# of looking them up for every new connection.
+dns_cache = {}
+dns_cache_lock = threading.Lock()
+uncachedGetaddrinfo = socket.getaddrinfo
+
+
+def cachedGetaddrinfo(*args, **kwargs):
+    key = (args, tuple(sorted(kwargs.items())))
+
+    with dns_cache_lock:
+        cached = dns_cache.get(key)
+    if cached is not None and time.time() - cached[0] < DNS_CACHE_TTL:
+        return cached[1]
+
+    start = time.time()
+    try:
+        addresses = uncachedGetaddrinfo(*args, **kwargs)
+    finally:
+        addTransportTiming("dns", start)
+
+    with dns_cache_lock:
+        dns_cache[key] = (time.time(), addresses)
+    return addresses
+
+
+socket.getaddrinfo = cachedGetaddrinfo
+
+
+def hostLimit(host):
+    return HOST_LIMITS.get(host, HTTP_WORKERS_PER_HOST)
+
+
+# Retries are up to fetch(), which counts them against the test's time.
+# With read=False, a read timeout comes through as requests' ReadTimeout,
+# rather than as a ConnectionError that would count against the host.
+def makeAdapter(pool_size):
+    return TimedAdapter(
+        pool_connections=HTTP_HOSTS,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=0, connect=0, read=False, redirect=0, status=0),
+    )
+
+
+# One keep-alive pool per host, sized to the number of requests that may be
+# in flight against it at once, so connections (and their TLS sessions) are
+# reused instead of being set up again for every test.
 session = requests.Session()
-adapter = HTTPAdapter(
-    max_retries=Retry(total=0, connect=0, read=0, redirect=0, status=0)
-)
+adapter = makeAdapter(HTTP_WORKERS_PER_HOST)
 session.mount("http://", adapter)
 session.mount("https://", adapter)
 
-options = Options()
-options.headless = True
+for host, limit in HOST_LIMITS.items():
+    host_adapter = makeAdapter(limit)
+    session.mount("http://{}/".format(host), host_adapter)
+    session.mount("https://{}/".format(host), host_adapter)
 
-caps = DesiredCapabilities().FIREFOX
-caps["pageLoadStrategy"] = "eager"
+# Selenium is slow to import, so it is only loaded once a JavaScript test
+# needs a browser. Runs of csv, json and url tests never load it.
+webdriver = None
+selenium_lock = threading.Lock()
 
-driver = webdriver.Firefox(
-    desired_capabilities=caps,
-    options=options,
-    executable_path="/usr/bin/geckodriver",
-    service_log_path="/tmp/geckodriver.log",
-)
 
-driver.set_page_load_timeout(900)
-actions = ActionChains(driver)
+def loadSelenium():
+    global webdriver, By, ActionChains, options, caps
 
-tests = {
-    "northernclimatereports.org": [
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://northernclimatereports.org/report/community/AK124#results",
-            "javascript": "return document.querySelectorAll('#temperature tbody td span').length > 200",
-            "text": "Temperature table is populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://northernclimatereports.org/report/community/AK124#results",
-            "javascript": "return document.querySelectorAll('#temp-chart .legend .traces').length > 5",
-            "text": "Temperature chart is populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://northernclimatereports.org/report/community/AK124#results",
-            "javascript": "return document.querySelectorAll('.report--temperature-indicators tbody td span').length > 80",
-            "text": "Temperature indicators chart is populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://northernclimatereports.org/report/community/AK124#results",
-            "javascript": "return document.querySelectorAll('#precipitation tbody td span').length > 200",
-            "text": "Precipitation table is populated",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://northernclimatereports.org/report/community/AK124#results",
-            "javascript": "return document.querySelectorAll('#precip-chart .legend .traces').length > 5",
-            "text": "Precipitation chart is populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://northernclimatereports.org/report/community/AK124#results",
-            "javascript": "return document.querySelectorAll('.report--precipitation-indicators tbody td span').length > 80",
-            "text": "Precipitation indicators chart is populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://northernclimatereports.org/report/community/AK124#results",
-            "javascript": "return document.querySelectorAll('#hydrology tbody td span').length > 200",
-            "text": "Hydrology tables are populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://northernclimatereports.org/report/community/AK124#results",
-            "javascript": "return document.querySelectorAll('#hydrology .leaflet-tile-loaded').length > 200",
-            "text": "Hydrology mini-maps loaded.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://northernclimatereports.org/report/community/AK124#results",
-            "javascript": "return document.querySelectorAll('#permafrost .leaflet-tile-loaded').length > 40",
-            "text": "Permafrost mini-maps loaded.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://northernclimatereports.org/report/community/AK124#results",
-            "javascript": "return document.querySelectorAll('#permafrost-top-chart .legend .traces').length > 3",
-            "text": "Permafrost depth to top of permafrost chart is populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://northernclimatereports.org/report/community/AK124#results",
-            "javascript": """
-                return _.filter(document.querySelectorAll('#wildfire .leaflet-tile-loaded'), (tile) => {
-                    return tile.src.indexOf('flammability') != -1
-                }).length > 20
-            """,
-            "text": "Flammability mini-maps loaded.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://northernclimatereports.org/report/community/AK124#results",
-            "javascript": "return document.querySelectorAll('#wildfire-flammability-chart .legend .traces').length > 5",
-            "text": "Flammability chart is populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://northernclimatereports.org/report/community/AK124#results",
-            "javascript": """
-                return _.filter(document.querySelectorAll('#wildfire .leaflet-tile-loaded'), (tile) => {
-                    return tile.src.indexOf('vegetation') != -1
-                }).length > 20
-            """,
-            "text": "Vegetation type mini-maps loaded.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://northernclimatereports.org/report/community/AK124#results",
-            "javascript": "return document.querySelectorAll('#wildfire-veg-change-chart .legend .traces').length > 5",
-            "text": "Vegetation type chart is populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://northernclimatereports.org/report/community/AK124#results",
-            "javascript": "return document.querySelectorAll('#climate-protection-beetles tbody td').length > 40",
-            "text": "Climate protection from beetles tables are populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://northernclimatereports.org/report/community/AK124#results",
-            "javascript": "return document.querySelectorAll('#climate-protection-beetles .leaflet-tile-loaded').length > 40",
-            "text": "Climate protection from beetles mini-maps loaded.",
-        },
-        {
-            "column": "webapp",
-            "type": "csv",
-            "url": "https://earthmaps.io/temperature/point/{lat}/{lon}?format=csv",
-            "lat_range": [62.70, 67.92],
-            "lon_range": [-158.50, -144.21],
-            "text": "Temperature API endpoint CSV is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "csv",
-            "url": "https://earthmaps.io/precipitation/point/{lat}/{lon}?format=csv",
-            "lat_range": [62.70, 67.92],
-            "lon_range": [-158.50, -144.21],
-            "text": "Precipitation API endpoint CSV is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "csv",
-            "url": "https://earthmaps.io/indicators/base/point/{lat}/{lon}?format=csv",
-            "lat_range": [62.70, 67.92],
-            "lon_range": [-158.50, -144.21],
-            "text": "Indicators API endpoint CSV is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "csv",
-            "url": "https://earthmaps.io/eds/hydrology/point/{lat}/{lon}?format=csv",
-            "lat_range": [62.70, 67.92],
-            "lon_range": [-158.50, -144.21],
-            "text": "Hydrology API endpoint CSV is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "csv",
-            "url": "https://earthmaps.io/permafrost/point/{lat}/{lon}?format=csv",
-            "lat_range": [62.70, 67.92],
-            "lon_range": [-158.50, -144.21],
-            "text": "Permafrost API endpoint CSV is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "csv",
-            "url": "https://earthmaps.io/alfresco/flammability/local/{lat}/{lon}?format=csv",
-            "lat_range": [63.72, 64.40],
-            "lon_range": [-157.15, -154.20],
-            "text": "Flammability API endpoint CSV is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "csv",
-            "url": "https://earthmaps.io/alfresco/veg_type/local/{lat}/{lon}?format=csv",
-            "lat_range": [62.70, 67.92],
-            "lon_range": [-158.50, -144.21],
-            "text": "Vegetation type API endpoint CSV is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "csv",
-            "url": "https://earthmaps.io/beetles/point/{lat}/{lon}?format=csv",
-            "lat_range": [64.55, 65.80],
-            "lon_range": [-158, -156],
-            "text": "Climate protection from beetles API endpoint CSV is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "json",
-            "url": "https://earthmaps.io/taspr/point/{lat}/{lon}",
-            "lat_range": [62.70, 67.92],
-            "lon_range": [-158.50, -144.21],
-            "text": "Temperature and precipitation API endpoint JSON is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "csv",
-            "url": "https://earthmaps.io/indicators/base/point/{lat}/{lon}",
-            "lat_range": [62.70, 67.92],
-            "lon_range": [-158.50, -144.21],
-            "text": "Indicators API endpoint JSON is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "csv",
-            "url": "https://earthmaps.io/eds/hydrology/point/{lat}/{lon}",
-            "lat_range": [62.70, 67.92],
-            "lon_range": [-158.50, -144.21],
-            "text": "Hydrology API endpoint JSON is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "json",
-            "url": "https://earthmaps.io/permafrost/point/{lat}/{lon}",
-            "lat_range": [62.70, 67.92],
-            "lon_range": [-158.50, -144.21],
-            "text": "Permafrost API endpoint JSON is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "json",
-            "url": "https://earthmaps.io/alfresco/flammability/local/{lat}/{lon}",
-            "lat_range": [63.72, 64.40],
-            "lon_range": [-157.15, -154.20],
-            "text": "Flammability API endpoint JSON is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "json",
-            "url": "https://earthmaps.io/alfresco/veg_type/local/{lat}/{lon}",
-            "lat_range": [62.70, 67.92],
-            "lon_range": [-158.50, -144.21],
-            "text": "Vegetation type API endpoint JSON is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "json",
-            "url": "https://earthmaps.io/beetles/point/{lat}/{lon}",
-            "lat_range": [64.55, 65.80],
-            "lon_range": [-158, -156],
-            "text": "Climate protection from beetles API endpoint JSON is valid ({lat}, {lon}).",
-        },
-    ],
-    "production-fire-tally.us-west-2.elasticbeanstalk.com": [
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/daily-fire-tally",
-            "javascript": "return document.querySelectorAll('#tally .legendlines').length > 5",
-            "text": "Statewide daily tally chart is populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/daily-fire-tally",
-            "javascript": "return document.querySelectorAll('#tally-zone .legendlines').length > 5",
-            "text": "Daily tally by protection chart graph is populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/daily-fire-tally",
-            "javascript": "return document.querySelectorAll('#tally-year .legendlines').length > 5",
-            "text": "Daily tally by year chart is populated.",
-        },
-    ],
-    "arcticeds.org": [
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://arcticeds.org/report/{lat}/{lon}",
-            "lat_range": [62, 62.5],
-            "lon_range": [-156, -153],
-            "javascript": "return document.querySelectorAll('.precipitation table td').length > 300",
-            "text": "Precipitation section loaded ({lat}, {lon}).",
-            "delay": 900,
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://arcticeds.org/report/{lat}/{lon}",
-            "lat_range": [62, 62.5],
-            "lon_range": [-156, -153],
-            "javascript": "return document.querySelectorAll('.pf table td').length > 100",
-            "text": "Precipitation frequency section loaded ({lat}, {lon}).",
-            "delay": 10,
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://arcticeds.org/report/{lat}/{lon}",
-            "lat_range": [62, 62.5],
-            "lon_range": [-156, -153],
-            "javascript": "return document.querySelectorAll('.temperature table td').length > 100",
-            "text": "Temperature section loaded ({lat}, {lon}).",
-            "delay": 10,
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://arcticeds.org/report/{lat}/{lon}",
-            "lat_range": [62, 62.5],
-            "lon_range": [-156, -153],
-            "javascript": "return document.querySelectorAll('.temperature-index table td').length > 100",
-            "text": "Temperature index section loaded ({lat}, {lon}).",
-            "delay": 10,
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://arcticeds.org/report/{lat}/{lon}",
-            "lat_range": [62, 62.5],
-            "lon_range": [-156, -153],
-            "javascript": "return document.querySelectorAll('.permafrost table td').length > 100",
-            "text": "Permafrost section loaded ({lat}, {lon}).",
-            "delay": 10,
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://arcticeds.org/maps",
-            "javascript": "return document.querySelectorAll('#precipitation .leaflet-tile-loaded').length > 20",
-            "text": "Precipitation map loaded.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://maps.earthmaps.io/rasdaman/ows?service=WMS&request=GetMap&layers=annual_precip_totals_mm&styles=precip_mm_midcentury_era&format=image%2Fpng&transparent=true&version=1.3.0&id=midcentury_era_precip&width=256&height=256&crs=EPSG%3A3338&bbox=70586,1493385,594874,2017673",
-            "text": "Projected precipitation map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://arcticeds.org/maps",
-            "javascript": "return document.querySelectorAll('#permafrost .leaflet-tile-loaded').length > 20",
-            "text": "Permafrost map loaded.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/wms?service=WMS&request=GetMap&layers=permafrost_beta%3Aobu_pf_extent&styles=&format=image%2Fpng&transparent=true&version=1.3.0&id=pfextent_obu&width=256&height=256&crs=EPSG%3A3338&bbox=70586,1493385,594874,2017673",
-            "text": "Permafrost extent (Obu) map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://arcticeds.org/maps",
-            "javascript": "return document.querySelectorAll('#temperature .leaflet-tile-loaded').length > 20",
-            "text": "Temperature map loaded.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://maps.earthmaps.io/rasdaman/ows?service=WMS&request=GetMap&layers=annual_mean_temp&styles=temp_midcentury_era&format=image%2Fpng&transparent=true&version=1.3.0&id=midcentury_era_annual_mean_temp&width=256&height=256&crs=EPSG%3A3338&bbox=70586,969097,594874,1493385",
-            "text": "Projected mean annual temperature map layer accessible.",
-        },
-    ],
-    "seaiceatlas.org": [
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://seaiceatlas.org",
-            "javascript": "return document.querySelectorAll('#map .leaflet-tile-loaded').length > 20",
-            "text": "Sea ice map loaded.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://seaiceatlas.org",
-            "click": "#map",
-            "click_x_offset": 800,
-            "click_y_offset": 100,
-            "javascript": "return document.querySelectorAll('.js-line').length > 0",
-            "text": "Sea ice chart populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "json",
-            "url": "https://earthmaps.io/seaice/point/{lat}/{lon}/",
-            "lat_range": [71.50, 73.60],
-            "lon_range": [-177.5, -131.41],
-            "text": "Sea ice API endpoint JSON is valid.",
-        },
-        {
-            "column": "webapp",
-            "type": "csv",
-            "url": "https://earthmaps.io/seaice/point/{lat}/{lon}?format=csv",
-            "lat_range": [71.50, 73.60],
-            "lon_range": [-177.5, -131.41],
-            "text": "Sea ice API endpoint CSV is valid at {lat}, {lon}.",
-        },
-    ],
-    "production-wrcc-wind-tool.us-west-2.elasticbeanstalk.com": [
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/airport-winds",
-            "javascript": "return document.querySelectorAll('#map canvas').length > 1",
-            "text": "Airport map loaded.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/airport-winds",
-            "javascript": "return document.querySelectorAll('#rose g').length > 100",
-            "text": "Rose chart populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/airport-winds",
-            "javascript": "return document.querySelectorAll('#rose_monthly g').length > 1000",
-            "text": "Rose monthly charts populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/airport-winds",
-            "javascript": "return document.querySelectorAll('#exceedance_plot g').length > 80",
-            "text": "Exceedence chart populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/airport-winds",
-            "javascript": "return document.querySelectorAll('#wep_box path').length > 15",
-            "text": "Wind energy potential chart populated.",
-        },
-    ],
-    "production-usda-dash.us-west-2.elasticbeanstalk.com": [
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/gardenhelper",
-            "javascript": "return document.querySelectorAll('#tcharts g').length > 100",
-            "text": "Growing season chart populated.",
-            "delay": 60,
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/gardenhelper",
-            "click": ".tab:nth-of-type(2)",
-            "javascript": "return document.querySelectorAll('#acharts path').length > 1000",
-            "text": "Annual minimums chart populated.",
-            "delay": 120,
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/gardenhelper",
-            "click": ".tab:nth-of-type(3)",
-            "javascript": "return document.querySelectorAll('#ccharts .legendlines').length > 10",
-            "text": "Growing degree days chart populated.",
-            "delay": 60,
-        },
-    ],
-    "alaskawildfires.org": [
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://alaskawildfires.org",
-            "javascript": "return document.querySelectorAll('#map--leaflet-map div').length > 10 || document.querySelectorAll('.intro').length == 0",
-            "text": "Wildfire map loaded or inactive.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/alaska-wildfires",
-            "javascript": "return document.querySelectorAll('#map--leaflet-map div').length > 10 || document.querySelectorAll('.intro').length == 0",
-            "text": "Wildfire map redirects to https://alaskawildfires.org.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/alaska_wildfires/wms?service=WMS&request=GetMap&layers=alaska_wildfires%3Afire_points&format=image%2Fpng&transparent=true&version=1.3&continuousWorld=true&tiled=false&crs=EPSG%3A3338&width=256&height=256&bbox=594874,1493385,1119162,2017673",
-            "text": "Fire points map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/alaska_wildfires/wms?service=WMS&request=GetMap&layers=alaska_wildfires%3Afire_polygons&format=image%2Fpng&transparent=true&version=1.3&continuousWorld=true&tiled=false&crs=EPSG%3A3338&width=256&height=256&bbox=594874,1493385,1119162,2017673",
-            "text": "Fire polygons map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/alaska_wildfires/wms?service=WMS&request=GetMap&layers=alaska_wildfires%3Aviirs_hotspots&format=image%2Fpng&transparent=true&version=1.3&continuousWorld=true&tiled=false&crs=EPSG%3A3338&width=256&height=256&bbox=594874,1493385,1119162,2017673",
-            "text": "VIIRS hotspots map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/wms?service=WMS&request=GetMap&layers=alaska_wildfires%3Alightning_strikes&styles=&format=image%2Fpng&transparent=true&version=1.3&continuousWorld=true&tiled=true&srs=EPSG%3A3338&width=256&height=256&crs=EPSG%3A3338&bbox=594874,1493385,1119162,2017673",
-            "text": "Lightning strikes map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/alaska_wildfires/wms?service=WMS&request=GetMap&layers=alaska_wildfires%3Apurple_air&format=image%2Fpng&transparent=true&version=1.3&continuousWorld=true&tiled=false&crs=EPSG%3A3338&width=256&height=256&bbox=594874,1493385,1119162,2017673",
-            "text": "Purple Air AQI sensors map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/alaska_wildfires/wms?service=WMS&request=GetMap&layers=alaska_wildfires%3Aaqi_forecast_6_hrs&format=image%2Fpng&transparent=true&version=1.3&continuousWorld=true&tiled=false&crs=EPSG%3A3338&width=256&height=256&bbox=594874,1493385,1119162,2017673",
-            "text": "AQI 6 hour forecast map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/alaska_wildfires/wms?service=WMS&request=GetMap&layers=alaska_wildfires%3Aaqi_forecast_12_hrs&format=image%2Fpng&transparent=true&version=1.3&continuousWorld=true&tiled=false&crs=EPSG%3A3338&width=256&height=256&bbox=594874,1493385,1119162,2017673",
-            "text": "AQI 12 hour forecast map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/alaska_wildfires/wms?service=WMS&request=GetMap&layers=alaska_wildfires%3Aaqi_forecast_24_hrs&format=image%2Fpng&transparent=true&version=1.3&continuousWorld=true&tiled=false&crs=EPSG%3A3338&width=256&height=256&bbox=594874,1493385,1119162,2017673",
-            "text": "AQI 24 hour forecast map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/alaska_wildfires/wms?service=WMS&request=GetMap&layers=alaska_wildfires%3Aaqi_forecast_48_hrs&format=image%2Fpng&transparent=true&version=1.3&continuousWorld=true&tiled=false&crs=EPSG%3A3338&width=256&height=256&bbox=594874,1493385,1119162,2017673",
-            "text": "AQI 48 hour forecast map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/wms?service=WMS&request=GetMap&layers=alaska_wildfires%3Aspruceadj_3338&styles=alaska_wildfires%3Aspruce_adjective&format=image%2Fpng&transparent=true&version=1.3&continuousWorld=true&tiled=true&srs=EPSG%3A3338&time=&id=spruceadj_3338&width=256&height=256&crs=EPSG%3A3338&bbox=-453701,444809,70586,969097",
-            "text": "Fire danger ratings map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/wms?service=WMS&request=GetMap&layers=alaska_wildfires%3Aalaska_landcover_2015&styles=&format=image%2Fpng&transparent=true&version=1.3&continuousWorld=true&tiled=true&srs=EPSG%3A3338&time=&id=alaska_landcover_2015&width=256&height=256&crs=EPSG%3A3338&bbox=-453701,969097,70586,1493385",
-            "text": "Land cover types map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/wms?service=WMS&request=GetMap&layers=alaska_wildfires%3Alightning-monthly-climatology&styles=&format=image%2Fpng&transparent=true&version=1.3&continuousWorld=true&tiled=true&srs=EPSG%3A3338&time=2015-5-01T00%3A00%3A00Z&id=gridded_lightning&width=256&height=256&crs=EPSG%3A3338&bbox=70586,1493385,594874,2017673",
-            "text": "Historical lightning strikes map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/wms?service=WMS&request=GetMap&layers=historical_fire_perimeters&styles=historical_fire_polygon_buckets&format=image%2Fpng&transparent=true&version=1.3&continuousWorld=true&tiled=true&srs=EPSG%3A3338&time=&id=historical_fire_perimeters&width=256&height=256&crs=EPSG%3A3338&bbox=70586,1493385,594874,2017673",
-            "text": "Historical fire perimeters map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://maps.earthmaps.io/rasdaman/ows?service=WMS&request=GetMap&layers=alfresco_relative_flammability_30yr&styles=alaska_wildfire_explorer_historical&format=image%2Fpng&transparent=true&version=1.3.0&continuousWorld=true&tiled=true&srs=EPSG%3A3338&time=&id=alfresco_relative_flammability_cru_ts40_historical_1950_2008_iem&dim_model=0&dim_scenario=0&width=256&height=256&crs=EPSG%3A3338&bbox=70586.06568358204,1493385.882955057,594874.0656835823,2017673.8829550678",
-            "text": "Historical modeled flammability map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://maps.earthmaps.io/rasdaman/ows?service=WMS&request=GetMap&layers=alfresco_relative_flammability_30yr&styles=alaska_wildfire_explorer_projected&format=image%2Fpng&transparent=true&version=1.3.0&continuousWorld=true&tiled=true&srs=EPSG%3A3338&time=&id=alfresco_relative_flammability_NCAR-CCSM4_rcp85_2070_2099&dim_model=6&dim_scenario=3&width=256&height=256&crs=EPSG%3A3338&bbox=70586.06568358204,1493385.882955057,594874.0656835823,2017673.8829550678",
-            "text": "Projected flammability map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/wms?service=WMS&request=GetMap&layers=all_boundaries%3Aall_gmus&styles=&format=image%2Fpng&transparent=true&version=1.3.0&continuousWorld=true&tiled=true&srs=EPSG%3A3338&time=&id=gmu&dim_model=&dim_scenario=&width=256&height=256&crs=EPSG%3A3338&bbox=-453701.9343164183,969097.8829550534,70586.06568358072,1493385.8829550538",
-            "text": "Game Management Units map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/wms?service=WMS&request=GetMap&layers=all_boundaries%3Aall_protected_areas&styles=&format=image%2Fpng&transparent=true&version=1.3.0&continuousWorld=true&tiled=true&srs=EPSG%3A3338&time=&id=protected_areas&dim_model=&dim_scenario=&width=256&height=256&crs=EPSG%3A3338&bbox=70586.06568358286,969097.882955058,594874.0656835833,1493385.8829550613",
-            "text": "Protected Areas map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/wms?service=WMS&request=GetMap&layers=all_boundaries%3Aall_fire_zones&styles=&format=image%2Fpng&transparent=true&version=1.3.0&continuousWorld=true&tiled=true&srs=EPSG%3A3338&time=&id=fire_zones&dim_model=&dim_scenario=&width=256&height=256&crs=EPSG%3A3338&bbox=70586.06568358286,969097.882955058,594874.0656835833,1493385.8829550613",
-            "text": "Fire Management Units map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "json",
-            "url": "https://earthmaps.io/fire/point/{lat}/{lon}",
-            "lat_range": [62, 62.5],
-            "lon_range": [-156, -153],
-            "text": "Fire API endpoint JSON is valid ({lat}, {lon}).",
-        },
-    ],
-    "production22222.us-west-2.elasticbeanstalk.com": [
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://www.snap.uaf.edu/tools/nwt-climate-explorer",
-            "javascript": "return document.querySelectorAll('#minesites-map canvas').length > 1",
-            "text": "Location map loaded.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://www.snap.uaf.edu/tools/nwt-climate-explorer",
-            "javascript": "return document.querySelectorAll('#my-graph .legendlines').length > 1",
-            "text": "Temperature chart populated.",
-        },
-    ],
-    "production-dash-cc.us-west-2.elasticbeanstalk.com": [
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/community-charts",
-            "javascript": "return document.querySelectorAll('#ccharts g').length > 100",
-            "text": "Average temperature chart populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "csv",
-            "url": "https://snap.uaf.edu/tools/community-charts/dash/dlCSV?value=AK124",
-            "text": "Community charts CSV is valid.",
-        },
-    ],
-    "permafrost-production.us-west-2.elasticbeanstalk.com": [
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/permafrost",
-            "javascript": "return document.querySelectorAll('#weather-plot path.point').length > 3",
-            "text": "Permafrost risk chart populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/permafrost",
-            "javascript": "return document.querySelectorAll('#community-table tr').length > 1",
-            "text": "Permafrost risk table populated.",
-        },
-    ],
-    "windtool.accap.uaf.edu": [
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "http://windtool.accap.uaf.edu/",
-            "javascript": "return document.querySelectorAll('#map canvas').length > 1",
-            "text": "Location map loaded.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "http://windtool.accap.uaf.edu/",
-            "javascript": "return document.querySelectorAll('#means_box path.box').length > 5",
-            "text": "Monthly wind speed plot populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "http://windtool.accap.uaf.edu/",
-            "javascript": "return document.querySelectorAll('#rose g').length > 100",
-            "text": "Wind speed plot populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "http://windtool.accap.uaf.edu/",
-            "javascript": "return document.querySelectorAll('#rose_monthly g').length > 1000",
-            "text": "Monthly wind speed plot populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "http://windtool.accap.uaf.edu/",
-            "javascript": "return document.querySelectorAll('#threshold_graph g').length > 100",
-            "text": "Modeled wind duration plot populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "http://windtool.accap.uaf.edu/",
-            "javascript": "return document.querySelectorAll('#future_delta_percentiles g').length > 80",
-            "text": "Modeled past and future wind plot populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "http://windtool.accap.uaf.edu/",
-            "javascript": "return document.querySelectorAll('#future_rose g').length > 500",
-            "text": "Modeled wind speed plot populated.",
-        },
-    ],
-    "living-off-the-land.s3-website-us-west-2.amazonaws.com": [
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/living-off-the-land",
-            "javascript": "return document.querySelectorAll('#ice-and-snow__map path').length > 100",
-            "text": "Ice observations map loaded.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/wms?service=WMS&request=GetMap&layers=nasa_above%3Awintertemp_2010s_tcc&styles=&format=image%2Fpng&transparent=true&version=1.3&srs=EPSG%3A3338&tiled=true&continuousWorld=true&width=256&height=256&crs=EPSG%3A3338&bbox=70586,1493385,594874,2017673",
-            "text": "Winter temperature (2010) map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/living-off-the-land",
-            "javascript": "return document.querySelectorAll('#snowday-fraction-map__map path').length > 80",
-            "text": "Snow observations map loaded.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/wms?service=WMS&request=GetMap&layers=nasa_above%3AOct_snowdayfraction_2010s_tcc_reprojected&styles=&format=image%2Fpng&transparent=true&version=1.3&srs=EPSG%3A3338&tiled=true&continuousWorld=true&width=256&height=256&crs=EPSG%3A3338&bbox=70586,1493385,594874,2017673",
-            "text": "Snow observations (2010) map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/living-off-the-land",
-            "javascript": "return document.querySelectorAll('#permafrost-map__map path').length > 150",
-            "text": "Permafrost map loaded.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/wms?service=WMS&request=GetMap&layers=nasa_above%3AJuly_permafrost_2m_2010s_tcc&styles=&format=image%2Fpng&transparent=true&version=1.3&srs=EPSG%3A3338&tiled=true&continuousWorld=true&width=256&height=256&crs=EPSG%3A3338&bbox=70586,1493385,594874,2017673",
-            "text": "Permafrost (2010) map layer accessible.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/living-off-the-land",
-            "javascript": "return document.querySelectorAll('#historical-fires__map path').length > 40",
-            "text": "Historical fire map loaded.",
-        },
-        {
-            "column": "webapp",
-            "type": "url",
-            "url": "https://gs.earthmaps.io/geoserver/wms?service=WMS&request=GetMap&layers=alaska_wildfires%3Ahistorical_fire_perimeters&styles=fire_history_70s_2010s&format=image%2Fpng&transparent=true&version=1.3&srs=EPSG%3A3338&tiled=true&continuousWorld=true&width=256&height=256&crs=EPSG%3A3338&bbox=70586,1493385,594874,2017673",
-            "text": "Historical fires map layer accessible.",
-        },
-    ],
-    "production-swti.eba-spvr3kbd.us-west-2.elasticbeanstalk.com": [
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://accap.uaf.edu/tools/statewide-temperature-index",
-            "javascript": "return document.querySelectorAll('#daily-index .traces').length > 1",
-            "text": "Chart populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "csv",
-            "url": "https://accap.uaf.edu/tools/statewide-temperature-index/downloads/statewide_temperature_daily_index.csv",
-            "text": "CSV is valid.",
-        },
-    ],
-    "fish-and-fire.s3-website-us-west-2.amazonaws.com": [
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/fish-and-fire/",
-            "javascript": "return document.querySelectorAll('#map .leaflet-tile-loaded').length > 15",
-            "text": "Location selector map loaded.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/fish-and-fire/report/fb653a",
-            "javascript": "return document.querySelectorAll('#map path').length > 3",
-            "text": "Polygon loaded on report page.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/fish-and-fire/report/fb653a",
-            "javascript": "return document.querySelectorAll('#chart .legend .traces').length > 5",
-            "text": "Riparian fire index chart is populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/fish-and-fire/report/fb653a",
-            "javascript": "return document.querySelectorAll('#hydro-stats-chart-1 .legend .traces').length > 1",
-            "text": "Hydrology stats chart is populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/fish-and-fire/report/fb653a",
-            "javascript": "return document.querySelectorAll('#hydrograph-chart-1 .legend .traces').length > 1",
-            "text": "Hydrograph chart is populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/fish-and-fire/report/fb653a",
-            "javascript": "return document.querySelectorAll('#stream-temp-chart-4 .legend .traces').length > 1",
-            "text": "Stream temperature chart is populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "javascript",
-            "url": "https://snap.uaf.edu/tools/fish-and-fire/report/fb653a",
-            "javascript": "return document.querySelectorAll('#fish-growth-chart-4 .legend .traces').length > 1",
-            "text": "Fish growth chart is populated.",
-        },
-        {
-            "column": "webapp",
-            "type": "json",
-            "url": "https://gs.earthmaps.io/geoserver/fish_and_fire/ows?service=WFS&version=1.0.0&request=GetFeature&typeName=fish_and_fire%3AAOIs&outputFormat=application%2Fjson&PropertyName=(AOI_Name_,Category)",
-            "text": "GeoServer returns valid JSON from shapefile.",
-        },
-    ],
-    "arcticdatascience.org": [
-        {
-            "column": "webapp",
-            "type": "json",
-            "url": "https://earthmaps.io/cmip6/point/{lat}/{lon}?vars=tas",
-            "lat_range": [62.70, 67.92],
-            "lon_range": [-158.50, -144.21],
-            "text": "CMIP6 tas API endpoint JSON is valid ({lat}, {lon}).",
-            "delay": 90,
-        },
-        {
-            "column": "webapp",
-            "type": "json",
-            "url": "https://earthmaps.io/indicators/cmip6/point/{lat}/{lon}",
-            "lat_range": [62.70, 67.92],
-            "lon_range": [-158.50, -144.21],
-            "text": "CMIP6 indicators API endpoint JSON is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "json",
-            "url": "https://earthmaps.io/temperature_anomalies/point/{lat}/{lon}",
-            "lat_range": [62.70, 67.92],
-            "lon_range": [-158.50, -144.21],
-            "text": "Temperature anomalies API endpoint JSON is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "json",
-            "url": "https://earthmaps.io/permafrost/point/gipl/{lat}/{lon}",
-            "lat_range": [62.70, 67.92],
-            "lon_range": [-158.50, -144.21],
-            "text": "Permafrost API endpoint JSON is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "json",
-            "url": "https://earthmaps.io/alfresco/flammability/local/{lat}/{lon}",
-            "lat_range": [62.70, 67.92],
-            "lon_range": [-158.50, -144.21],
-            "text": "Flammability API endpoint JSON is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "json",
-            "url": "https://earthmaps.io/alfresco/veg_type/local/{lat}/{lon}",
-            "lat_range": [62.70, 67.92],
-            "lon_range": [-158.50, -144.21],
-            "text": "Vegetation type API endpoint JSON is valid ({lat}, {lon}).",
-        },
-        {
-            "column": "webapp",
-            "type": "json",
-            "url": "https://earthmaps.io/landfastice/point/{lat}/{lon}",
-            "lat_range": [71, 71.5],
-            "lon_range": [-150, -148],
-            "text": "Landfast sea ice extent API endpoint JSON is valid ({lat}, {lon}).",
-        },
-    ],
+    with selenium_lock:
+        if webdriver is not None:
+            return
+
+        from selenium import webdriver as selenium_webdriver
+        from selenium.webdriver.common.desired_capabilities import (
+            DesiredCapabilities,
+        )
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.firefox.options import Options
+        from selenium.webdriver.common.action_chains import ActionChains
+
+        options = Options()
+        options.headless = True
+
+        # Newer Firefox only lets Marionette run scripts in the chrome context,
+        # which applyBlockList() and the profiler need, with this argument.
+        # The default block list is set at launch too, so most pages don't
+        # need the chrome context at all.
+        options.add_argument("-remote-allow-system-access")
+        for name, value in blockPrefs(blockList({})).items():
+            options.set_preference(name, value)
+
+        caps = DesiredCapabilities().FIREFOX
+        caps["pageLoadStrategy"] = "eager"
+
+        webdriver = selenium_webdriver
+
+
+TEST_TYPES = ("javascript", "csv", "json", "url")
+REQUIRED_KEYS = ("column", "type", "url", "text")
+
+# Every key a test may have, and what kind of value it takes.
+TEST_KEYS = {
+    "column": "string",
+    "type": "string",
+    "url": "string",
+    "text": "string",
+    "id": "string",
+    "javascript": "script",
+    "lat_range": "range",
+    "lon_range": "range",
+    "points": "list of points",
+    "click": "string",
+    "click_ready": "script",
+    "click_x_offset": "number",
+    "click_y_offset": "number",
+    "delay": "number",
+    "interval": "number",
+    "timeout": "number",
+    "rows": "number",
+    "full": "boolean",
+    "required": "list of strings",
+    "min_items": "number",
+    "max_size": "number",
+    "cache": "boolean",
+    "block": "list of strings",
 }
 
 
-def processCoords(test):
-    if "lat_range" not in test or "lon_range" not in test:
-        return test
+def isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
 
-    if "arcticeds.org" in test["url"]:
-        if not hasattr(processCoords, "arcticeds_coords"):
-            lat_range = test["lat_range"]
-            lon_range = test["lon_range"]
-            processCoords.arcticeds_coords = {
-                "lat": round(random.uniform(lat_range[0], lat_range[1]), 2),
-                "lon": round(random.uniform(lon_range[0], lon_range[1]), 2),
-            }
-        coords = processCoords.arcticeds_coords
+def isPair(value):
+    return isinstance(value, list) and len(value) == 2 and all(map(isNumber, value))
+
+
+def isStringList(value):
+    return isinstance(value, list) and all(isinstance(v, str) for v in value)
+
+
+VALUE_CHECKS = {
+    "string": lambda value: isinstance(value, str),
+    "number": isNumber,
+    "boolean": lambda value: isinstance(value, bool),
+    "list of strings": isStringList,
+    # A script may be split into a list of lines for readability.
+    "script": lambda value: isinstance(value, str) or isStringList(value),
+    "range": isPair,
+    "list of points": lambda value: (
+        isinstance(value, list) and len(value) > 0 and all(map(isPair, value))
+    ),
+}
+
+
+# Return a list of everything wrong with one test entry.
+def validateTest(test):
+    if not isinstance(test, dict):
+        return ["should be an object"]
+
+    errors = []
+
+    for key in REQUIRED_KEYS:
+        if key not in test:
+            errors.append('missing "{}"'.format(key))
+
+    for key, value in test.items():
+        if key not in TEST_KEYS:
+            errors.append('unknown key "{}"'.format(key))
+        elif not VALUE_CHECKS[TEST_KEYS[key]](value):
+            errors.append('"{}" should be a {}'.format(key, TEST_KEYS[key]))
+
+    if errors:
+        return errors
+
+    if test["type"] not in TEST_TYPES:
+        errors.append('unknown type "{}"'.format(test["type"]))
+
+    if test["type"] == "javascript" and "javascript" not in test:
+        errors.append('javascript tests need "javascript"')
+
+    if ("lat_range" in test) != ("lon_range" in test):
+        errors.append('"lat_range" and "lon_range" go together')
+    elif "lat_range" not in test:
+        if "points" in test:
+            errors.append('"points" needs "lat_range" and "lon_range"')
+
+        for key in ("url", "text"):
+            if "{lat}" in test[key] or "{lon}" in test[key]:
+                errors.append('"{}" uses {{lat}}/{{lon}} without a range'.format(key))
     else:
-        lat_range = test["lat_range"]
-        lon_range = test["lon_range"]
-        coords = {
-            "lat": round(random.uniform(lat_range[0], lat_range[1]), 2),
-            "lon": round(random.uniform(lon_range[0], lon_range[1]), 2),
-        }
+        # The same substitution applyCoords() makes on every run.
+        for key in ("url", "text"):
+            try:
+                test[key].format(lat=0, lon=0)
+            except (KeyError, IndexError, ValueError, AttributeError) as error:
+                errors.append(
+                    '"{}" should only use {{lat}} and {{lon}} ({}: {})'.format(
+                        key, type(error).__name__, error
+                    )
+                )
 
-    test["url"] = test["url"].format(**coords)
-    test["text"] = test["text"].format(**coords)
+    if "click_ready" in test and "click" not in test:
+        errors.append('"click_ready" needs "click"')
+
+    if ("click_x_offset" in test) != ("click_y_offset" in test):
+        errors.append('"click_x_offset" and "click_y_offset" go together')
+
+    if "id" in test and not re.fullmatch("[A-Za-z0-9_]+", test["id"]):
+        errors.append('"id" may only use letters, digits and underscores')
+
+    return errors
+
+
+MACHINE_KEYS = ("tests", "same_point", "block")
+
+
+def validateMachine(entries):
+    if not isinstance(entries, dict):
+        return "should contain a list of tests"
+    for key in entries:
+        if key not in MACHINE_KEYS:
+            return 'unknown key "{}"'.format(key)
+    if not isinstance(entries.get("tests"), list):
+        return '"tests" should be a list of tests'
+    if not isinstance(entries.get("same_point", False), bool):
+        return '"same_point" should be a boolean'
+    if not isStringList(entries.get("block", [])):
+        return '"block" should be a list of strings'
+    return None
+
+
+# Make every lat/lon test of a machine draw from the pool of its first one,
+# so they all use the same point in a run.
+def sharePoints(machine_tests):
+    ranged = [test for test in machine_tests if "lat_range" in test]
+    if not ranged:
+        return
+
+    source = {
+        key: ranged[0][key]
+        for key in ("lat_range", "lon_range", "points")
+        if key in ranged[0]
+    }
+    for test in ranged:
+        test["shared_points"] = source
+
+
+def compileTest(test):
+    test = dict(test)
+    for key in ("javascript", "click_ready"):
+        if isinstance(test.get(key), list):
+            test[key] = "\n".join(test[key])
     return test
 
 
-def javascriptTest(test):
-    try:
-        delay = test.get("delay", 20)
-        driver.get(test["url"])
-        time.sleep(delay)
+def readTestFile(path):
+    with open(path) as test_file:
+        if path.endswith(".json"):
+            return json.load(test_file)
+        if yaml is None:
+            raise ValueError("PyYAML is needed to read YAML files")
+        return yaml.safe_load(test_file)
 
-        if "click" in test:
-            element = driver.find_element(By.CSS_SELECTOR, test["click"])
 
-            if "click_x_offset" in test and "click_y_offset" in test:
-                driver.execute_script("arguments[0].scrollIntoView();", element)
-                actions.move_to_element_with_offset(
-                    element, test["click_x_offset"], test["click_y_offset"]
-                ).click().perform()
-            else:
-                element.click()
+def testFiles(config_dir):
+    names = sorted(os.listdir(config_dir))
+    return [
+        os.path.join(config_dir, name)
+        for name in names
+        if name.endswith((".json", ".yaml", ".yml"))
+    ]
 
-            time.sleep(delay)
 
-        return driver.execute_script(test["javascript"])
+# The catalog is reloaded only when a test file is added, removed or modified.
+# Invalid entries are left out and listed in problems, so one bad entry can't
+# stop the rest of the tests from running.
+catalog_cache = {}
 
-    except Exception:
-        return False
 
+def loadCatalog(config_dir=CONFIG_DIR):
+    files = testFiles(config_dir)
+    signature = [(path, os.path.getmtime(path)) for path in files]
 
-def csvTest(test):
-    try:
-        timeout = test.get("timeout", DEFAULT_REQUEST_TIMEOUT)
-        response = session.get(test["url"], timeout=timeout)
+    if catalog_cache.get("signature") == signature:
+        return catalog_cache["catalog"]
 
-        if response.status_code != 200:
-            return False
+    tests = {}
+    problems = {}
 
-        no_metadata = []
-        for row in re.split("\r?\n", response.text):
-            if len(row) > 0 and row[0] != "#":
-                no_metadata.append(row)
+    for path in files:
+        name = os.path.basename(path)
+        machine = os.path.splitext(name)[0]
 
-        reader = csv.reader(no_metadata)
-        next(reader)
-        return True
+        try:
+            entries = readTestFile(path)
+        except Exception as error:
+            problems[machine] = ["{}: {}".format(name, error)]
+            continue
 
-    except Exception:
-        return False
+        # A file is either a list of tests, or an object with the tests and
+        # options for the whole machine.
+        if isinstance(entries, list):
+            entries = {"tests": entries}
 
+        error = validateMachine(entries)
+        if error:
+            problems[machine] = ["{}: {}".format(name, error)]
+            continue
 
-def jsonTest(test):
-    try:
-        timeout = test.get("timeout", DEFAULT_REQUEST_TIMEOUT)
-        response = session.get(test["url"], timeout=timeout)
+        tests[machine] = []
+        for number, test in enumerate(entries["tests"], 1):
+            errors = validateTest(test)
+            for error in errors:
+                message = "{} test {}: {}".format(name, number, error)
+                problems.setdefault(machine, []).append(message)
+            if not errors:
+                test = compileTest(test)
+                if "block" in entries:
+                    test.setdefault("block", entries["block"])
+                tests[machine].append(test)
 
-        if response.status_code != 200:
-            return False
+        if entries.get("same_point", False):
+            sharePoints(tests[machine])
 
-        response.json()
-        return True
+    catalog_cache["signature"] = signature
+    catalog_cache["catalog"] = (tests, problems)
+    return catalog_cache["catalog"]
 
-    except Exception:
-        return False
 
+def reportProblems(problems):
+    for machine_problems in problems.values():
+        for problem in machine_problems:
+            print("Invalid test skipped: " + problem, file=sys.stderr)
 
-def urlTest(test):
-    try:
-        timeout = test.get("timeout", DEFAULT_REQUEST_TIMEOUT)
-        response = session.get(test["url"], timeout=timeout)
-        return response.status_code == 200
-    except Exception:
+
+# Tests picked on the command line: machines ("hosts"), types and columns to
+# run, and a pattern to look for in each test's text or URL. None runs every
+# test.
+test_selection = None
+selection_cache = {}
+
+
+def testSelected(test):
+    types = test_selection["types"]
+    columns = test_selection["columns"]
+    pattern = test_selection["pattern"]
+
+    if types and test["type"] not in types:
+        return False
+    if columns and test["column"] not in columns:
         return False
+    if pattern is not None:
+        return bool(pattern.search(test["text"]) or pattern.search(test["url"]))
+    return True
 
 
-for machine in tests.keys():
-    colors = {}
-    messages = {}
+# The selected part of a catalog, worked out again only when it changes.
+def selectTests(catalog):
+    if test_selection is None:
+        return catalog
+    if selection_cache.get("catalog") is catalog:
+        return selection_cache["selected"]
 
-    for test in tests[machine]:
-        column = test["column"]
+    tests, problems = catalog
+    hosts = test_selection["hosts"]
 
-        if column not in colors:
-            colors[column] = "green"
-            messages[column] = ""
+    selected_tests = {}
+    for machine, machine_tests in tests.items():
+        if hosts and machine not in hosts:
+            continue
+        machine_tests = [test for test in machine_tests if testSelected(test)]
+        if machine_tests:
+            selected_tests[machine] = machine_tests
 
-        test = processCoords(test)
+    selected_problems = {
+        machine: machine_problems
+        for machine, machine_problems in problems.items()
+        if not hosts or machine in hosts
+    }
 
-        success = False
+    selection_cache["catalog"] = catalog
+    selection_cache["selected"] = (selected_tests, selected_problems)
+    return selection_cache["selected"]
 
-        if test["type"] == "javascript":
-            success = javascriptTest(test)
-        elif test["type"] == "json":
-            success = jsonTest(test)
-        elif test["type"] == "csv":
-            success = csvTest(test)
-        elif test["type"] == "url":
-            success = urlTest(test)
-
-        if success:
-            messages[column] += "&green " + test["text"] + "\n"
-        else:
-            colors[column] = "red"
-            messages[column] += "&red " + test["text"] + "\n"
 
-    for column in colors.keys():
-        date = subprocess.check_output(["date"]).decode("ascii")
-        status = "status {}.{} {} {}\n{}".format(
-            machine, column, colors[column], date, messages[column]
-        )
-        subprocess.call([xymon, xymsrv, status])
+# Coordinates come from a fixed pool of points for each range: either the
+# test's own "points", or COORD_POOL_SIZE points drawn with a seeded random
+# number generator, so the same range always has the same pool. Each run
+# uses the next point in the pool, so every point comes around again.
+def coordPool(source):
+    if "points" in source:
+        return [{"lat": lat, "lon": lon} for lat, lon in source["points"]]
+
+    lat_range = source["lat_range"]
+    lon_range = source["lon_range"]
+    rng = random.Random("{}:{}:{}".format(COORD_SEED, lat_range, lon_range))
+    return [
+        {
+            "lat": round(rng.uniform(lat_range[0], lat_range[1]), 2),
+            "lon": round(rng.uniform(lon_range[0], lon_range[1]), 2),
+        }
+        for i in range(COORD_POOL_SIZE)
+    ]
+
+
+# Which point of each pool to use, set by --rotation or by the time of day.
+coord_rotation = None
+
+
+def currentRotation():
+    if coord_rotation is not None:
+        return coord_rotation
+    return int(time.time() // ROTATION_PERIOD)
+
+
+def processCoords(test, rotation):
+    if "lat_range" not in test or "lon_range" not in test:
+        return test
+
+    # Tests on a "same_point" machine all share the machine's pool.
+    pool = coordPool(test.get("shared_points", test))
+    point = rotation % len(pool)
+    return applyCoords(test, dict(pool[point], point=point, rotation=rotation))
+
 
-driver.quit()
+def applyCoords(test, coords):
+    test = dict(test)
+    test["template"] = test["text"]
+    test["url"] = test["url"].format(**coords)
+    test["text"] = test["text"].format(**coords)
+    test["coords"] = coords
+    return test
+
+
+def resolveTests(batch, rotation=None):
+    if rotation is None:
+        rotation = currentRotation()
+    return [processCoords(test, rotation) for test in batch]
+
+
+# Tests of the same URL share one fetch per run (see runHttpTests), but only
+# if they get the same point. So a test whose range takes in the point already
+# picked for another test of its URL uses that point too. Tests with the
+# narrowest ranges pick first. Tests with their own "points", or on a
+# "same_point" machine, keep theirs.
+def alignCoords(tests, plan):
+    candidates = []
+    for machine, machine_tests in tests.items():
+        for index, test in enumerate(machine_tests):
+            if test["type"] not in httpTests or "coords" not in plan[machine][index]:
+                continue
+            if "points" in test or "shared_points" in test:
+                continue
+            lat_range, lon_range = test["lat_range"], test["lon_range"]
+            area = (lat_range[1] - lat_range[0]) * (lon_range[1] - lon_range[0])
+            candidates.append((area, machine, index))
+
+    picked = {}
+    for area, machine, index in sorted(candidates):
+        test = tests[machine][index]
+        lat_range, lon_range = test["lat_range"], test["lon_range"]
+
+        for coords in picked.get(test["url"], []):
+            lat_ok = lat_range[0] <= coords["lat"] <= lat_range[1]
+            lon_ok = lon_range[0] <= coords["lon"] <= lon_range[1]
+            if lat_ok and lon_ok:
+                plan[machine][index] = applyCoords(test, coords)
+                break
+        else:
+            coords = plan[machine][index]["coords"]
+            picked.setdefault(test["url"], []).append(coords)
+
+
+def pageKey(test):
+    return (
+        test["url"],
+        test.get("click"),
+        test.get("click_ready"),
+        test.get("click_x_offset"),
+        test.get("click_y_offset"),
+        tuple(blockList(test)),
+    )
+
+
+# Raised while polling a page whose browser has died, which no amount of
+# waiting will fix.
+class BrowserDied(Exception):
+    pass
+
+
+# Call condition every POLL_INTERVAL seconds until it returns something truthy
+# or timeout seconds have passed. Exceptions count as "not yet", except
+# BrowserDied, which ends the wait at once.
+def pollUntil(condition, timeout):
+    deadline = time.time() + timeout
+
+    while True:
+        try:
+            if condition():
+                return True
+        except BrowserDied:
+            raise
+        except Exception:
+            pass
+
+        if time.time() >= deadline:
+            return False
+
+        time.sleep(POLL_INTERVAL)
+
+
+# Seconds left before a deadline, which may be None for no deadline.
+def remainingTime(deadline):
+    if deadline is None:
+        return float("inf")
+    return deadline - time.time()
+
+
+# The most time a single test may take. HTTP tests take their "timeout", or
+# their "delay" if they only set that.
+def testBudget(test):
+    if test["type"] == "javascript":
+        return test.get("delay", 20)
+    return test.get("timeout", test.get("delay", DEFAULT_REQUEST_TIMEOUT))
+
+
+# Never start more browsers than there is available memory for.
+def browserWorkerCount():
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    available_mb = int(line.split()[1]) // 1024
+                    affordable = available_mb // BROWSER_MEMORY_MB
+                    return max(1, min(BROWSER_WORKERS, affordable))
+    except (OSError, ValueError):
+        pass
+
+    return 1
+
+
+# Each browser worker thread owns one Firefox. Every Firefox is started with
+# a fresh temporary profile, so workers never share cookies or cache.
+browser = threading.local()
+drivers = []
+drivers_lock = threading.Lock()
+
+
+def getDriver():
+    if getattr(browser, "driver", None) is None:
+        loadSelenium()
+        driver = webdriver.Firefox(
+            desired_capabilities=caps,
+            options=options,
+            executable_path="/usr/bin/geckodriver",
+            service_log_path=os.path.join(STATE_DIR, "geckodriver.log"),
+        )
+        driver.set_page_load_timeout(PAGE_LOAD_TIMEOUT)
+        browser.driver = driver
+        browser.pages = 0
+        browser.block = blockList({})
+
+        with drivers_lock:
+            drivers.append(driver)
+
+    return browser.driver
+
+
+def quitDriver(driver):
+    with drivers_lock:
+        if driver in drivers:
+            drivers.remove(driver)
+
+    try:
+        driver.quit()
+    except Exception:
+        pass
+
+
+# Throw away this worker's Firefox; the next page it runs starts a new one.
+def recycleDriver():
+    driver = getattr(browser, "driver", None)
+    browser.driver = None
+    browser.block = None
+
+    if driver is not None:
+        quitDriver(driver)
+
+
+def blockList(test):
+    return sorted(test.get("block", DEFAULT_BLOCK))
+
+
+# Firefox can't filter requests by URL itself, so blocked hosts are sent to a
+# proxy that doesn't exist by a proxy auto-config script. HTTPS requests only
+# show the PAC script their host, so hosts are all that can be blocked.
+def pacScript(hosts):
+    conditions = " || ".join(
+        "shExpMatch(host, {})".format(json.dumps(host)) for host in hosts
+    )
+    return (
+        "function FindProxyForURL(url, host) {{"
+        ' return ({}) ? "PROXY 127.0.0.1:9" : "DIRECT"; }}'
+    ).format(conditions)
+
+
+# Runs in Firefox's chrome context, where preferences can be changed.
+SET_PREFS_SCRIPT = """
+const prefs = arguments[0];
+for (const [name, value] of Object.entries(prefs)) {
+    if (typeof value === "boolean") {
+        Services.prefs.setBoolPref(name, value);
+    } else if (typeof value === "number") {
+        Services.prefs.setIntPref(name, value);
+    } else {
+        Services.prefs.setStringPref(name, value);
+    }
+}
+"""
+
+
+# The preferences that block what a page's tests don't need.
+def blockPrefs(block):
+    hosts = [entry for entry in block if entry not in ("fonts", "images", "trackers")]
+    return {
+        "gfx.downloadable_fonts.enabled": "fonts" not in block,
+        "permissions.default.image": 2 if "images" in block else 1,
+        "privacy.trackingprotection.enabled": "trackers" in block,
+        "network.proxy.type": 2 if hosts else 0,
+        "network.proxy.failover_direct": False,
+        "network.proxy.autoconfig_url": (
+            "data:text/javascript," + quote(pacScript(hosts)) if hosts else ""
+        ),
+    }
+
+
+# Problems with the browser that would otherwise be logged for every page.
+warnings_given = set()
+warnings_lock = threading.Lock()
+
+
+def warnOnce(message):
+    with warnings_lock:
+        if message in warnings_given:
+            return
+        warnings_given.add(message)
+    print(message, file=sys.stderr)
+
+
+# Each browser starts with the default block list. Workers load pages for
+# different machines, so this is done before every page, but only changes
+# anything when the block list differs from the last page's.
+def applyBlockList(driver, block):
+    if getattr(browser, "block", None) == block:
+        return
+
+    try:
+        with driver.context(driver.CONTEXT_CHROME):
+            driver.execute_script(SET_PREFS_SCRIPT, blockPrefs(block))
+        browser.block = block
+    except Exception:
+        # Without the preferences the page still loads, just more slowly.
+        warnOnce("Can't change Firefox preferences, so pages use DEFAULT_BLOCK")
+
+
+# Total resident memory, in MB, of a process and all of its descendants.
+def processTreeMemory(pid):
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(entry)) as stat:
+                parent = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open("/proc/{}/statm".format(current)) as statm:
+                total += int(statm.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            pass
+
+    return total // (1024 * 1024)
+
+
+# Memory used by geckodriver, Firefox and Firefox's content processes.
+def browserMemory(driver):
+    try:
+        return processTreeMemory(driver.service.process.pid)
+    except Exception:
+        return None
+
+
+# Firefox grows as it renders page after page, so a worker's Firefox is
+# replaced once it has loaded BROWSER_MAX_PAGES pages or outgrown its share
+# of memory. Returns the memory it was using.
+def checkBrowserLifecycle(driver):
+    browser.pages += 1
+    memory = browserMemory(driver)
+
+    too_big = memory is not None and memory > BROWSER_MEMORY_MB
+    if too_big or browser.pages >= BROWSER_MAX_PAGES:
+        recycleDriver()
+
+    return memory
+
+
+def driverAlive(driver):
+    try:
+        driver.current_url
+        return True
+    except Exception:
+        return False
+
+
+# Summarize the page's Navigation Timing and Resource Timing entries, in
+# seconds from the start of the navigation: how long the page took to reach
+# the server, respond, and fire DOMContentLoaded and load (null if it hasn't
+# yet), the slowest requests it made, and the requests to each host. The
+# JavaScript heap size is only there in browsers that report it.
+PAGE_TIMING_SCRIPT = """
+const seconds = (ms) => Math.round(ms) / 1000;
+const summary = {};
+
+const nav = performance.getEntriesByType("navigation")[0];
+if (nav) {
+    summary.dns = seconds(nav.domainLookupEnd - nav.domainLookupStart);
+    summary.connect = seconds(nav.connectEnd - nav.connectStart);
+    summary.ttfb = seconds(nav.responseStart - nav.startTime);
+    summary.dom_content_loaded = seconds(nav.domContentLoadedEventEnd);
+    summary.load = nav.loadEventEnd > 0 ? seconds(nav.loadEventEnd) : null;
+}
+
+const resources = performance.getEntriesByType("resource");
+summary.resources = resources.length;
+summary.slowest_resources = resources
+    .slice()
+    .sort((a, b) => b.duration - a.duration)
+    .slice(0, arguments[0])
+    .map((entry) => ({
+        url: entry.name,
+        initiator: entry.initiatorType,
+        start: seconds(entry.startTime),
+        duration: seconds(entry.duration),
+        size: entry.transferSize,
+    }));
+
+summary.hosts = {};
+for (const entry of resources) {
+    let host;
+    try {
+        host = new URL(entry.name).hostname;
+    } catch (error) {
+        continue;
+    }
+    const stats = summary.hosts[host] || { requests: 0, slowest: 0, end: 0 };
+    stats.requests += 1;
+    stats.slowest = Math.max(stats.slowest, seconds(entry.duration));
+    stats.end = Math.max(stats.end, seconds(entry.responseEnd));
+    summary.hosts[host] = stats;
+}
+
+if (performance.memory) {
+    summary.js_heap = performance.memory.usedJSHeapSize;
+}
+
+return summary;
+"""
+
+
+def pageTiming(driver):
+    try:
+        return driver.execute_script(PAGE_TIMING_SCRIPT, SLOWEST_RESOURCES)
+    except Exception:
+        return None
+
+
+# With --trace, a page whose tests failed or were slow (see checkLatency) is
+# loaded and checked again with the Firefox profiler running, and both its
+# profile and a HAR network log built from its Resource Timing entries are
+# saved in TRACE_DIR. None of this happens without --trace.
+trace_pages = False
+
+START_PROFILER_SCRIPT = """
+Services.profiler.StartProfiler(
+    arguments[0], 1, ["js", "stackwalk", "leaf"], ["GeckoMain", "Compositor"]
+);
+"""
+
+# dumpProfileToFileAsync() writes the profile from the Firefox process.
+SAVE_PROFILE_SCRIPT = """
+const [path, done] = arguments;
+Services.profiler.dumpProfileToFileAsync(path).then(
+    () => {
+        Services.profiler.StopProfiler();
+        done(true);
+    },
+    (error) => {
+        Services.profiler.StopProfiler();
+        done(false);
+    }
+);
+"""
+
+# A HAR 1.2 log of the page and every request it made. Resource Timing has no
+# headers, methods or status text, so those are left empty, and the phases of
+# cross-origin requests without a Timing-Allow-Origin header come out as zero.
+PAGE_HAR_SCRIPT = """
+const origin = performance.timeOrigin;
+const span = (start, end) => (start > 0 && end >= start ? end - start : -1);
+const nav = performance.getEntriesByType("navigation")[0];
+const entries = (nav ? [nav] : []).concat(performance.getEntriesByType("resource"));
+
+return {
+    log: {
+        version: "1.2",
+        creator: { name: "snap.py", version: "1" },
+        pages: [{
+            startedDateTime: new Date(origin).toISOString(),
+            id: "page",
+            title: document.title,
+            pageTimings: {
+                onContentLoad: nav ? nav.domContentLoadedEventEnd : -1,
+                onLoad: nav && nav.loadEventEnd > 0 ? nav.loadEventEnd : -1,
+            },
+        }],
+        entries: entries.map((entry) => ({
+            pageref: "page",
+            startedDateTime: new Date(origin + entry.startTime).toISOString(),
+            time: entry.duration,
+            request: {
+                method: "GET",
+                url: entry.name,
+                httpVersion: entry.nextHopProtocol || "",
+                cookies: [],
+                headers: [],
+                queryString: [],
+                headersSize: -1,
+                bodySize: -1,
+            },
+            response: {
+                status: entry.responseStatus || 0,
+                statusText: "",
+                httpVersion: entry.nextHopProtocol || "",
+                cookies: [],
+                headers: [],
+                content: { size: entry.decodedBodySize || 0, mimeType: "" },
+                redirectURL: "",
+                headersSize: -1,
+                bodySize: entry.encodedBodySize || -1,
+            },
+            cache: {},
+            timings: {
+                blocked: span(entry.fetchStart, entry.domainLookupStart),
+                dns: span(entry.domainLookupStart, entry.domainLookupEnd),
+                connect: span(entry.connectStart, entry.connectEnd),
+                ssl: span(entry.secureConnectionStart, entry.connectEnd),
+                send: 0,
+                wait: Math.max(0, span(entry.requestStart, entry.responseStart)),
+                receive: Math.max(0, span(entry.responseStart, entry.responseEnd)),
+            },
+            _initiator: entry.initiatorType,
+        })),
+    },
+};
+"""
+
+
+def startProfiler(driver):
+    entries = TRACE_BUFFER_MB * 1024 * 1024 // 8
+
+    try:
+        with driver.context(driver.CONTEXT_CHROME):
+            driver.execute_script(START_PROFILER_SCRIPT, entries)
+        return True
+    except Exception:
+        # Not every Firefox build has the profiler; the HAR is still saved.
+        warnOnce("Can't start the Firefox profiler; traces only have the HAR")
+        return False
+
+
+# Save the trace of the page in the browser, and return the paths written.
+def saveTrace(driver, name, profiling):
+    os.makedirs(TRACE_DIR, exist_ok=True)
+    base = os.path.join(TRACE_DIR, name)
+    paths = []
+
+    try:
+        har = driver.execute_script(PAGE_HAR_SCRIPT)
+        with open(base + ".har", "w") as har_file:
+            json.dump(har, har_file)
+        paths.append(base + ".har")
+    except Exception:
+        pass
+
+    if profiling:
+        try:
+            with driver.context(driver.CONTEXT_CHROME):
+                saved = driver.execute_async_script(
+                    SAVE_PROFILE_SCRIPT, base + ".profile.json"
+                )
+            if saved:
+                paths.append(base + ".profile.json")
+        except Exception:
+            pass
+
+    pruneTraces()
+    return paths
+
+
+# Remove traces older than TRACE_MAX_AGE, then the oldest ones until the rest
+# fit in TRACE_MAX_MB.
+def pruneTraces():
+    try:
+        traces = []
+        for name in os.listdir(TRACE_DIR):
+            path = os.path.join(TRACE_DIR, name)
+            stat = os.stat(path)
+            traces.append((stat.st_mtime, stat.st_size, path))
+
+        traces.sort(reverse=True)
+        total = 0
+        for mtime, size, path in traces:
+            total += size
+            too_old = time.time() - mtime > TRACE_MAX_AGE
+            if too_old or total > TRACE_MAX_MB * 1024 * 1024:
+                os.remove(path)
+    except OSError:
+        pass
+
+
+def traceName(machine, url):
+    page = re.sub(r"[^A-Za-z0-9]+", "-", urlparse(url).path).strip("-")
+    return "{}-{}-{}".format(
+        time.strftime("%Y%m%dT%H%M%S"), machine, page[:60] or "index"
+    )
+
+
+# Whether a page's results call for a trace: a test failed (other than by
+# running out of run time, or with the browser), or passed but was slow.
+def pageNeedsTrace(machine, page_tests, records):
+    for test, record in zip(page_tests, records):
+        if record.get("skipped") or record.get("crashed"):
+            continue
+        if not record["success"]:
+            return True
+
+        p95 = usualP95().get((machine, testKey(test)))
+        if p95 is not None and tooSlow(record["wall"], p95):
+            return True
+
+    return False
+
+
+def evaluateJavascript(driver, test, record):
+    start = time.time()
+
+    try:
+        return bool(driver.execute_script(test["javascript"]))
+    except Exception:
+        # An error in the script means "not yet", unless the browser is gone.
+        if not driverAlive(driver):
+            raise BrowserDied()
+        return False
+    finally:
+        record["script"] += time.time() - start
+
+
+# Pages are only loaded as far as DOMContentLoaded ("eager"), which is too
+# soon for the scripts of a page that must be clicked.
+CLICK_READY_SCRIPT = 'return document.readyState == "complete";'
+
+
+# Load a page once and run the JavaScript of every test that shares it. Each
+# test passes as soon as its JavaScript returns true; tests that are still
+# false when the page's delay (the longest delay of its tests) runs out fail.
+# Nothing waits past the deadline; tests it cuts short are marked "skipped".
+def javascriptTests(page_tests, deadline=None, trace_name=None):
+    start = time.time()
+    records = [{"success": False, "script": 0.0} for test in page_tests]
+
+    if remainingTime(deadline) <= 0:
+        for record in records:
+            record.update(wall=0.0, skipped="not run")
+        return records
+
+    def finish(record):
+        record["wall"] = time.time() - start
+        record["wait"] = record["wall"] - record.get("page_load", 0.0)
+        if not record["success"] and remainingTime(deadline) <= 0:
+            record["skipped"] = "not finished"
+
+    try:
+        driver = getDriver()
+        first = page_tests[0]
+        driver.set_page_load_timeout(min(PAGE_LOAD_TIMEOUT, remainingTime(deadline)))
+        applyBlockList(driver, blockList(first))
+        profiling = trace_name is not None and startProfiler(driver)
+        driver.get(first["url"])
+
+        # Keep the timings of every request the page makes, not just the first
+        # few hundred. Map pages load far more tiles than that.
+        driver.execute_script(
+            "performance.setResourceTimingBufferSize(arguments[0]);",
+            RESOURCE_BUFFER_SIZE,
+        )
+
+        page_load = time.time() - start
+        for record in records:
+            record["page_load"] = page_load
+
+        delay = max(testBudget(test) for test in page_tests)
+        delay = min(delay, remainingTime(deadline))
+
+        if "click" in first:
+            # The element may be there well before the page's scripts can
+            # handle a click on it, so wait until the page has finished
+            # loading and the test's "click_ready" script, if any, is true.
+            def findClickTarget():
+                try:
+                    if not driver.execute_script(CLICK_READY_SCRIPT):
+                        return None
+                    if "click_ready" in first:
+                        if not driver.execute_script(first["click_ready"]):
+                            return None
+                    return driver.find_element(By.CSS_SELECTOR, first["click"])
+                except Exception:
+                    if not driverAlive(driver):
+                        raise BrowserDied()
+                    raise
+
+            if not pollUntil(findClickTarget, delay):
+                for record in records:
+                    finish(record)
+                if trace_name is not None:
+                    trace = saveTrace(driver, trace_name, profiling)
+                    for record in records:
+                        record["trace"] = trace
+                return records
+
+            element = findClickTarget()
+
+            if "click_x_offset" in first and "click_y_offset" in first:
+                driver.execute_script("arguments[0].scrollIntoView();", element)
+                ActionChains(driver).move_to_element_with_offset(
+                    element, first["click_x_offset"], first["click_y_offset"]
+                ).click().perform()
+            else:
+                element.click()
+
+        delay = min(delay, remainingTime(deadline))
+
+    except Exception:
+        # A browser that crashed or hung won't be trusted with the next page.
+        crashed = not driverAlive(getattr(browser, "driver", None))
+        recycleDriver()
+        for record in records:
+            finish(record)
+            if crashed:
+                record["crashed"] = True
+        return records
+
+    pending = set(range(len(page_tests)))
+
+    def checkPending():
+        for index in sorted(pending):
+            if evaluateJavascript(driver, page_tests[index], records[index]):
+                records[index]["success"] = True
+                finish(records[index])
+                pending.discard(index)
+        return not pending
+
+    try:
+        pollUntil(checkPending, delay)
+        crashed = False
+    except BrowserDied:
+        crashed = True
+
+    for index in pending:
+        finish(records[index])
+
+    if crashed or not driverAlive(driver):
+        recycleDriver()
+        for index in pending:
+            records[index]["crashed"] = True
+        return records
+
+    # Once the tests are done, so the requests they waited for are included.
+    navigation = pageTiming(driver)
+    if navigation is not None:
+        for record in records:
+            record["navigation"] = navigation
+
+    if trace_name is not None:
+        trace = saveTrace(driver, trace_name, profiling)
+        for record in records:
+            record["trace"] = trace
+
+    memory = checkBrowserLifecycle(driver)
+    if memory is not None:
+        for record in records:
+            record["browser_memory"] = memory
+
+    return records
+
+
+# If the browser died while loading or checking a page, its tests failed
+# through no fault of the page, so they get one more try on a new browser.
+def runPage(machine, page_tests, deadline=None):
+    records = javascriptTests(page_tests, deadline)
+
+    if any(record.get("crashed") for record in records):
+        records = javascriptTests(page_tests, deadline)
+        for record in records:
+            record["retried"] = True
+
+    # The traced run is only kept for its trace; the results stand.
+    if trace_pages and pageNeedsTrace(machine, page_tests, records):
+        name = traceName(machine, page_tests[0]["url"])
+        trace = javascriptTests(page_tests, deadline, name)[0].get("trace")
+        if trace:
+            for record in records:
+                record["trace"] = trace
+
+    return records
+
+
+# Run a machine's JavaScript tests one page at a time on a browser worker,
+# quickest pages first. Pages from different machines run on different
+# workers at the same time. Results are added to results as each page
+# finishes, so they are there even if the deadline passes partway through.
+def runPages(machine, machine_tests, pages, deadline=None, results=None):
+    if results is None:
+        results = {}
+
+    def pageBudget(indexes):
+        return max(testBudget(machine_tests[i]) for i in indexes)
+
+    for indexes in sorted(pages.values(), key=pageBudget):
+        page_tests = [machine_tests[i] for i in indexes]
+        results.update(zip(indexes, runPage(machine, page_tests, deadline)))
+
+    return results
+
+
+# The response cache remembers the ETag and Last-Modified of every csv, json
+# or url response that passed, so the next run can ask the server whether it
+# has changed. A "304 Not Modified" counts as a pass. Entries are keyed by the
+# URL and the test's assertions, so changing those re-checks the body, but
+# the rotation and pool a lat/lon test's point came from don't matter.
+CACHE_KEYS = ("type", "url", "rows", "full", "required", "min_items", "max_size")
+
+
+def cachePath(test):
+    fields = {key: test[key] for key in CACHE_KEYS if key in test}
+    key = json.dumps(fields, sort_keys=True).encode("utf-8")
+    return os.path.join(CACHE_DIR, hashlib.sha256(key).hexdigest() + ".json")
+
+
+def cacheLoad(test):
+    if not test.get("cache", True):
+        return None
+
+    try:
+        path = cachePath(test)
+        with open(path) as cache_file:
+            entry = json.load(cache_file)
+        if time.time() - entry["stored"] > CACHE_MAX_AGE:
+            return None
+
+        # The mtime marks the last use, for evicting the least recently used.
+        os.utime(path)
+        return entry
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def cacheStore(test, record):
+    if not test.get("cache", True) or record.get("status_code") != 200:
+        return
+    if "etag" not in record and "last_modified" not in record:
+        return
+
+    entry = {"url": test["url"], "stored": time.time()}
+    for key in ("etag", "last_modified"):
+        if key in record:
+            entry[key] = record[key]
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        path = cachePath(test)
+        with open(path + ".tmp", "w") as cache_file:
+            json.dump(entry, cache_file)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass
+
+
+def pruneCache():
+    try:
+        entries = [
+            os.path.join(CACHE_DIR, name)
+            for name in os.listdir(CACHE_DIR)
+            if name.endswith(".json")
+        ]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for path in entries[CACHE_MAX_ENTRIES:]:
+            os.remove(path)
+    except OSError:
+        pass
+
+
+# Every test is a GET, so it is safe to retry one that failed to connect,
+# was reset before the response arrived, or hit an overloaded server (502,
+# 503 or 504). Read timeouts aren't retried. Each attempt only gets what is
+# left of the test's time, and there is no retry once too little is left to
+# wait out the backoff.
+def fetch(test, record, stream=False, deadline=None, conditional=True):
+    end = time.time() + min(testBudget(test), remainingTime(deadline))
+
+    headers = {}
+    cached = cacheLoad(test) if conditional else None
+    if cached is not None:
+        if "etag" in cached:
+            headers["If-None-Match"] = cached["etag"]
+        if "last_modified" in cached:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    record["retries"] = 0
+    while True:
+        timeout = max(0.0, end - time.time())
+        backoff = HTTP_BACKOFF * 2 ** record["retries"]
+
+        resetTransportTimings()
+        try:
+            response = session.get(
+                test["url"],
+                timeout=(min(CONNECT_TIMEOUT, timeout), timeout),
+                stream=stream,
+                headers=headers,
+            )
+        except requests.exceptions.SSLError:
+            raise
+        except requests.exceptions.ConnectionError:
+            if record["retries"] >= HTTP_RETRIES or end - time.time() <= backoff:
+                # Still failing to connect (or being reset) after every retry
+                # there was time for.
+                record["unreachable"] = True
+                raise
+        else:
+            if response.status_code not in (502, 503, 504):
+                break
+            if record["retries"] >= HTTP_RETRIES or end - time.time() <= backoff:
+                break
+            response.close()
+
+        time.sleep(backoff)
+        record["retries"] += 1
+
+    # requests stops the clock once the response headers have been parsed.
+    # Whatever part of that wasn't spent setting up a connection (zero when a
+    # pooled one was reused) was spent waiting on the server.
+    record["ttfb"] = response.elapsed.total_seconds()
+    record["dns"] = transport.dns
+    record["connect"] = transport.tcp - transport.dns
+    record["tls"] = transport.setup - transport.tcp
+    record["server"] = max(0.0, record["ttfb"] - transport.setup)
+    record["status_code"] = response.status_code
+    if "ETag" in response.headers:
+        record["etag"] = response.headers["ETag"]
+    if "Last-Modified" in response.headers:
+        record["last_modified"] = response.headers["Last-Modified"]
+    if not stream:
+        record["size"] = len(response.content)
+    return response
+
+
+# Check the header and the first "rows" data rows, or every row if "full" is
+# set, without holding more than one row in memory. Every checked row must
+# have as many columns as the header.
+def validateCsv(lines, test):
+    no_metadata = (line for line in lines if len(line) > 0 and line[0] != "#")
+    reader = csv.reader(no_metadata)
+    header = next(reader)
+
+    full = test.get("full", False)
+    wanted = test.get("rows", 0)
+    rows = reader if full else itertools.islice(reader, wanted)
+
+    checked = 0
+    for row in rows:
+        if len(row) != len(header):
+            return False
+        checked += 1
+
+    return full or checked == wanted
+
+
+# The lines of a response, like iter_lines(), counting the bytes read so far
+# in the record's "size". That is less than the full body when validation
+# stops early. urllib3 doesn't count what it reads of a chunked response, so
+# response.raw.tell() can't be used.
+def countedLines(response, record):
+    record["size"] = 0
+
+    def chunks():
+        for chunk in response.iter_content(requests.models.ITER_CHUNK_SIZE):
+            record["size"] += len(chunk)
+            yield chunk
+
+    pending = ""
+    for text in requests.utils.stream_decode_response_unicode(chunks(), response):
+        lines = (pending + text).splitlines(True)
+        pending = ""
+        if lines and not lines[-1].endswith(("\n", "\r")):
+            pending = lines.pop()
+        for line in lines:
+            yield line.rstrip("\r\n")
+
+    if pending:
+        yield pending
+
+
+# Each test fetches its own response, unless it is given one that was already
+# fetched for every test of the same URL.
+def csvTest(test, record, deadline=None, response=None):
+    try:
+        if response is None:
+            response = fetch(test, record, stream=True, deadline=deadline)
+
+        with response:
+            if response.status_code == 304:
+                return True
+            if response.status_code != 200:
+                return False
+
+            if response.encoding is None:
+                response.encoding = "utf-8"
+
+            return validateCsv(countedLines(response, record), test)
+
+    except Exception:
+        return False
+
+
+# Events that start a JSON value, as ijson.parse() names them.
+JSON_VALUE_EVENTS = (
+    "start_map",
+    "start_array",
+    "null",
+    "boolean",
+    "integer",
+    "double",
+    "number",
+    "string",
+)
+
+
+# The same (prefix, event, value) events ijson.parse() would produce, for a
+# document that has already been parsed.
+def jsonEvents(value, prefix=""):
+    if isinstance(value, dict):
+        yield prefix, "start_map", None
+        for key, item in value.items():
+            yield prefix, "map_key", key
+            yield from jsonEvents(item, prefix + "." + key if prefix else key)
+        yield prefix, "end_map", None
+    elif isinstance(value, list):
+        yield prefix, "start_array", None
+        for item in value:
+            yield from jsonEvents(item, prefix + ".item" if prefix else "item")
+        yield prefix, "end_array", None
+    elif value is None:
+        yield prefix, "null", value
+    elif isinstance(value, bool):
+        yield prefix, "boolean", value
+    elif isinstance(value, (int, float)):
+        yield prefix, "number", value
+    else:
+        yield prefix, "string", value
+
+
+# Check a stream of parser events against the test's assertions: every path
+# in "required" is present, the top-level object or array has at least
+# "min_items" entries (a top-level string, number, boolean or null counts as
+# one), and no more than "max_size" bytes are read. Unless "full" is false,
+# the whole document must also parse.
+def validateJson(events, test, bytesRead):
+    required = set(test.get("required", []))
+    min_items = test.get("min_items", 1)
+    max_size = test.get("max_size")
+    full = test.get("full", True)
+
+    top_level = None
+    items = 0
+
+    for prefix, event, value in events:
+        if max_size is not None and bytesRead() > max_size:
+            return False
+
+        if top_level is None:
+            top_level = event
+
+        if event in JSON_VALUE_EVENTS:
+            required.discard(prefix)
+
+        if top_level == "start_map" and prefix == "" and event == "map_key":
+            items += 1
+        elif top_level == "start_array" and prefix == "item":
+            if event in JSON_VALUE_EVENTS:
+                items += 1
+        elif top_level not in ("start_map", "start_array"):
+            items = 1
+
+        settled = not required and items >= min_items and max_size is None
+        if settled and not full:
+            return True
+
+    if max_size is not None and bytesRead() > max_size:
+        return False
+
+    return not required and items >= min_items
+
+
+def jsonTest(test, record, deadline=None, response=None):
+    try:
+        if response is None:
+            response = fetch(test, record, stream=True, deadline=deadline)
+            body = response.raw
+            body.decode_content = True
+        else:
+            body = io.BytesIO(response.content)
+
+        with response:
+            if response.status_code == 304:
+                return True
+            if response.status_code != 200:
+                return False
+
+            try:
+                if ijson is None:
+                    events = jsonEvents(response.json())
+                else:
+                    events = ijson.parse(body)
+
+                return validateJson(events, test, body.tell)
+            finally:
+                record["size"] = body.tell()
+
+    except Exception:
+        return False
+
+
+def urlTest(test, record, deadline=None, response=None):
+    try:
+        if response is None:
+            response = fetch(test, record, deadline=deadline)
+        return response.status_code in (200, 304)
+    except Exception:
+        return False
+
+
+httpTests = {
+    "csv": csvTest,
+    "json": jsonTest,
+    "url": urlTest,
+}
+
+# Jobs waiting for their host, and the number running against each host. A
+# job only goes to the HTTP pool once its host is below its limit, so tests
+# queued for a busy host never hold up workers that other hosts could use.
+host_queues = {}
+host_running = {}
+host_queue_lock = threading.Lock()
+
+
+# Run fn(*args) on the HTTP pool once host has a free slot.
+def submitHttp(host, fn, *args):
+    future = Future()
+    with host_queue_lock:
+        host_queues.setdefault(host, collections.deque()).append((future, fn, args))
+    dispatchHost(host)
+    return future
+
+
+def dispatchHost(host):
+    jobs = []
+
+    with host_queue_lock:
+        queue = host_queues.get(host, ())
+        while queue and host_running.get(host, 0) < hostLimit(host):
+            future, fn, args = queue.popleft()
+            if not future.cancelled():
+                host_running[host] = host_running.get(host, 0) + 1
+                jobs.append((future, fn, args))
+
+    for future, fn, args in jobs:
+        http_pool.submit(runHostJob, host, future, fn, args)
+
+
+# The job counts as started (and can no longer be cancelled) only once a
+# worker picks it up.
+def runHostJob(host, future, fn, args):
+    try:
+        if future.set_running_or_notify_cancel():
+            future.set_result(fn(*args))
+    except BaseException as error:
+        future.set_exception(error)
+    finally:
+        with host_queue_lock:
+            host_running[host] -= 1
+        dispatchHost(host)
+
+
+# Consecutive connection failures of each host, and when the last one was.
+host_health = {}
+host_health_lock = threading.Lock()
+
+
+# A host whose last HOST_FAILURES tests all failed to connect is down: the
+# rest of its tests fail at once instead of each waiting to time out. Once
+# HOST_COOLDOWN has passed, one test at a time is let through to see whether
+# it is back.
+def hostDown(host):
+    with host_health_lock:
+        failures, last = host_health.get(host, (0, 0.0))
+        if failures < HOST_FAILURES:
+            return False
+        if time.time() - last < HOST_COOLDOWN:
+            return True
+        host_health[host] = (failures, time.time())
+        return False
+
+
+def hostChecked(host, reachable):
+    with host_health_lock:
+        if reachable:
+            host_health.pop(host, None)
+        else:
+            failures = host_health.get(host, (0, 0.0))[0]
+            host_health[host] = (failures + 1, time.time())
+
+
+# Run tests of one URL. Tests that share a URL share a single fetch of it,
+# whose body each of them checks, so the server is only asked once a run.
+# Tests that can't start before the deadline, or that fail because it cut
+# them short, are marked "skipped" rather than failed. Tests of a host that is
+# down fail without being run.
+def runHttpTests(group, deadline=None):
+    host = urlparse(group[0]["url"]).hostname
+    records = [{} for test in group]
+
+    if remainingTime(deadline) <= 0:
+        for record in records:
+            record.update(success=False, wall=0.0, skipped="not run")
+        return records
+
+    if hostDown(host):
+        for record in records:
+            record.update(success=False, wall=0.0, unreachable=True)
+        return records
+
+    start = time.time()
+
+    if len(group) == 1:
+        test, record = group[0], records[0]
+        record["success"] = httpTests[test["type"]](test, record, deadline)
+        record["wall"] = time.time() - start
+    else:
+        # The body is read in full, since some of the tests may need all
+        # of it, and without the cached validators of any one test.
+        fetched = {}
+        try:
+            response = fetch(
+                max(group, key=testBudget),
+                fetched,
+                deadline=deadline,
+                conditional=False,
+            )
+        except Exception:
+            response = None
+        fetch_time = time.time() - start
+
+        for test, record in zip(group, records):
+            check_start = time.time()
+            record.update(fetched, shared=len(group))
+            if response is None:
+                record["success"] = False
+            else:
+                check = httpTests[test["type"]]
+                record["success"] = check(test, record, deadline, response)
+            record["wall"] = fetch_time + time.time() - check_start
+
+    if records[0].get("unreachable"):
+        hostChecked(host, False)
+    elif "status_code" in records[0]:
+        hostChecked(host, True)
+
+    for test, record in zip(group, records):
+        if record["success"]:
+            cacheStore(test, record)
+        elif remainingTime(deadline) <= 0:
+            record["skipped"] = "not finished"
+    return records
+
+
+def writeRecords(records, run_start):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+
+    name = time.strftime("%Y%m%dT%H%M%S", time.localtime(run_start)) + ".jsonl"
+    with open(os.path.join(RESULTS_DIR, name), "a") as results_file:
+        for record in records:
+            results_file.write(json.dumps(record) + "\n")
+
+    runs = sorted(f for f in os.listdir(RESULTS_DIR) if f.endswith(".jsonl"))
+    for old in runs[:-RESULTS_KEEP]:
+        os.remove(os.path.join(RESULTS_DIR, old))
+
+
+# Every run's results also go into a SQLite database, for latency percentiles
+# over time. Each result is kept for HISTORY_RAW_DAYS; after that, the results
+# of each test are summed up by the hour.
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    time REAL, machine TEXT, test TEXT, host TEXT, type TEXT,
+    success INTEGER, wall REAL, ttfb REAL, page_load REAL
+);
+CREATE INDEX IF NOT EXISTS results_time ON results (time);
+CREATE INDEX IF NOT EXISTS results_test ON results (machine, test, time);
+CREATE TABLE IF NOT EXISTS hourly (
+    hour REAL, machine TEXT, test TEXT, host TEXT, type TEXT,
+    runs INTEGER, failures INTEGER,
+    wall_p50 REAL, wall_p95 REAL, wall_p99 REAL, wall_max REAL,
+    PRIMARY KEY (hour, machine, test)
+);
+"""
+
+
+def openHistory():
+    db = sqlite3.connect(HISTORY_DB)
+    db.executescript(HISTORY_SCHEMA)
+    return db
+
+
+# The value below which the given fraction of values fall, interpolating
+# between the two nearest ones.
+def percentile(values, fraction):
+    values = sorted(values)
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+# Skipped tests didn't get a result, so they are left out.
+def storeHistory(records, when):
+    rows = [
+        (
+            when,
+            record["machine"],
+            record["test"],
+            urlparse(record["url"]).hostname,
+            record["type"],
+            int(record["success"]),
+            record["wall"],
+            record.get("ttfb"),
+            record.get("page_load"),
+        )
+        for record in records
+        if not record.get("skipped")
+    ]
+    if not rows:
+        return
+
+    db = openHistory()
+    try:
+        with db:
+            db.executemany(
+                "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            downsampleHistory(db, when)
+    finally:
+        db.close()
+
+
+def downsampleHistory(db, now):
+    cutoff = now - HISTORY_RAW_DAYS * 24 * 60 * 60
+    cutoff -= cutoff % 3600
+
+    hours = {}
+    old = db.execute(
+        "SELECT time, machine, test, host, type, success, wall FROM results"
+        " WHERE time < ?",
+        (cutoff,),
+    )
+    for when, machine, test, host, test_type, success, wall in old:
+        key = (when - when % 3600, machine, test)
+        hour = hours.setdefault(key, {"host": host, "type": test_type, "walls": []})
+        hour["walls"].append(wall)
+        hour["failures"] = hour.get("failures", 0) + (not success)
+
+    for (hour_start, machine, test), hour in hours.items():
+        walls = hour["walls"]
+        db.execute(
+            "INSERT OR REPLACE INTO hourly VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                hour_start,
+                machine,
+                test,
+                hour["host"],
+                hour["type"],
+                len(walls),
+                hour["failures"],
+                percentile(walls, 0.5),
+                percentile(walls, 0.95),
+                percentile(walls, 0.99),
+                max(walls),
+            ),
+        )
+
+    db.execute("DELETE FROM results WHERE time < ?", (cutoff,))
+    db.execute(
+        "DELETE FROM hourly WHERE hour < ?",
+        (now - HISTORY_KEEP_DAYS * 24 * 60 * 60,),
+    )
+
+
+# p50, p95 and p99 of the wall time of passed tests since the given time,
+# for each group of results: by machine and test, or by URL host.
+def latencyPercentiles(since, by=("machine", "test")):
+    db = openHistory()
+    try:
+        rows = db.execute(
+            "SELECT {}, wall FROM results WHERE success = 1 AND time >= ?".format(
+                ", ".join(by)
+            ),
+            (since,),
+        ).fetchall()
+    finally:
+        db.close()
+
+    walls = {}
+    for row in rows:
+        walls.setdefault(row[:-1], []).append(row[-1])
+
+    return {
+        key: {
+            "runs": len(values),
+            "p50": percentile(values, 0.5),
+            "p95": percentile(values, 0.95),
+            "p99": percentile(values, 0.99),
+        }
+        for key, values in walls.items()
+    }
+
+
+# Each test's usual p95 over SLOW_WINDOW, worked out at most every
+# SLOW_REFRESH seconds. Tests with too few passes to go by are left out.
+usual_latency = {"time": 0.0, "p95": {}}
+
+
+def usualP95():
+    now = time.time()
+    if now - usual_latency["time"] >= SLOW_REFRESH:
+        try:
+            percentiles = latencyPercentiles(now - SLOW_WINDOW)
+        except sqlite3.Error:
+            percentiles = {}
+
+        usual_latency["time"] = now
+        usual_latency["p95"] = {
+            key: stats["p95"]
+            for key, stats in percentiles.items()
+            if stats["runs"] >= SLOW_MIN_RESULTS
+        }
+    return usual_latency["p95"]
+
+
+# More than SLOW_FACTOR times the usual p95, and more than SLOW_MIN_EXCESS
+# seconds longer, so quick tests aren't flagged for milliseconds.
+def tooSlow(wall, p95):
+    return wall > max(SLOW_FACTOR * p95, p95 + SLOW_MIN_EXCESS)
+
+
+# Mark a pass that was too slow for its usual p95.
+def checkLatency(record):
+    if not record["success"]:
+        return
+
+    p95 = usualP95().get((record["machine"], record["test"]))
+    if p95 is not None and tooSlow(record["wall"], p95):
+        record["slow"] = p95
+
+
+# Only the raw results are used, so the window stops at HISTORY_RAW_DAYS.
+def printPercentiles(hours):
+    if hours > HISTORY_RAW_DAYS * 24:
+        print(
+            "Only the last {} days of results are kept in full.".format(
+                HISTORY_RAW_DAYS
+            ),
+            file=sys.stderr,
+        )
+        hours = HISTORY_RAW_DAYS * 24
+    since = time.time() - hours * 60 * 60
+
+    print("Wall time of passed tests over the last {:g} hours:".format(hours))
+    for by in (("machine", "test"), ("host",)):
+        print()
+        print(
+            "  {:>6}  {:>8}  {:>8}  {:>8}  {}".format(
+                "runs", "p50", "p95", "p99", ", ".join(by)
+            )
+        )
+        percentiles = latencyPercentiles(since, by)
+        for key, stats in sorted(percentiles.items()):
+            print(
+                "  {:6d}  {:7.2f}s  {:7.2f}s  {:7.2f}s  {}".format(
+                    stats["runs"],
+                    stats["p50"],
+                    stats["p95"],
+                    stats["p99"],
+                    "  ".join(str(part) for part in key),
+                )
+            )
+
+
+def outcome(record):
+    if record["success"]:
+        return "pass"
+    if record.get("skipped"):
+        return "SKIP"
+    return "FAIL"
+
+
+def reportTimings(records, run_time):
+    print("Run finished in {:.1f}s ({} tests).".format(run_time, len(records)))
+    print("Slowest tests:")
+
+    slowest = sorted(records, key=lambda record: record["wall"], reverse=True)
+    for record in slowest[:SLOWEST_REPORTED]:
+        print(
+            "  {:8.1f}s  {:<5}  {}  {}".format(
+                record["wall"],
+                outcome(record),
+                record["machine"],
+                record["text"],
+            )
+        )
+
+        # What held up a slow page.
+        resources = record.get("navigation", {}).get("slowest_resources")
+        if resources:
+            print(
+                "  {:>8}  slowest request {:.1f}s: {}".format(
+                    "", resources[0]["duration"], resources[0]["url"]
+                )
+            )
+
+
+# Trend data for a column, in Xymon's "name : value" (NCV) format. Each test
+# is named by its "id" key, or by its position within the machine. Tests that
+# were skipped, or whose host was unreachable, have no timings worth graphing,
+# and a zero would look like the fastest run ever.
+def timingData(column_records):
+    lines = []
+
+    for index, record in column_records:
+        if record.get("skipped") or record.get("unreachable"):
+            continue
+
+        name = record.get("id") or "test{:02d}".format(index + 1)
+        lines.append("{}_wall : {:.3f}".format(name, record["wall"]))
+
+        if "ttfb" in record:
+            lines.append("{}_ttfb : {:.3f}".format(name, record["ttfb"]))
+        if "size" in record:
+            lines.append("{}_size : {}".format(name, record["size"]))
+        if "server" in record:
+            setup = record["dns"] + record["connect"] + record["tls"]
+            lines.append("{}_setup : {:.3f}".format(name, setup))
+            lines.append("{}_server : {:.3f}".format(name, record["server"]))
+
+    return "".join(line + "\n" for line in lines)
+
+
+# Same format as date(1), so status pages look as they always have.
+def xymonDate():
+    return time.strftime("%a %b %d %H:%M:%S %Z %Y")
+
+
+def deliverToXymon(message):
+    if XYMON_TRANSPORT == "tcp":
+        with socket.create_connection((xymsrv, XYMON_PORT), timeout=30) as conn:
+            conn.sendall(message.encode("utf-8"))
+            conn.shutdown(socket.SHUT_WR)
+    else:
+        # "@" makes the xymon client read the message from stdin.
+        subprocess.run([xymon, xymsrv, "@"], input=message.encode("utf-8"))
+
+
+# Deliver the status messages together as one combo message. A combo can only
+# carry status messages (xymond splits it at each "\n\nstatus"), so each data
+# message is sent on its own.
+def sendToXymon(updates):
+    if not updates:
+        return
+
+    # Runs of hand-picked tests print their statuses instead, so they don't
+    # replace a column's full status with part of it.
+    if not send_statuses:
+        print("\n".join(updates))
+        return
+
+    statuses = [update for update in updates if update.startswith("status")]
+    if statuses:
+        deliverToXymon("combo\n" + "\n".join(statuses))
+
+    for update in updates:
+        if not update.startswith("status"):
+            deliverToXymon(update)
+
+
+def annotateRecord(record, machine, test):
+    record.update(
+        machine=machine,
+        column=test["column"],
+        type=test["type"],
+        url=test["url"],
+        text=test["text"],
+    )
+    if "id" in test:
+        record["id"] = test["id"]
+    if "coords" in test:
+        record["coords"] = test["coords"]
+
+    record["test"] = testKey(test)
+
+
+# What the run history knows a test by, the same whatever its point.
+def testKey(test):
+    return "{}: {}".format(
+        test["column"], test.get("id") or test.get("template", test["text"])
+    )
+
+
+# Status and data messages for each column of a machine. Tests without a
+# result yet are left out. A lifetime (in minutes) keeps the status from
+# going purple between updates that are further apart than Xymon's default.
+# Problems with the machine's test file turn every column yellow. Tests that
+# are still running are listed as such, and leave their column yellow at best
+# and without a data message.
+def statusUpdates(
+    machine, machine_tests, results, lifetime=None, problems=(), running=()
+):
+    colors = {}
+    messages = {}
+    column_records = {}
+    unfinished = set()
+
+    for index, test in enumerate(machine_tests):
+        if index not in results and index not in running:
+            continue
+
+        column = test["column"]
+
+        if column not in colors:
+            colors[column] = "green"
+            messages[column] = ""
+            column_records[column] = []
+
+        if index in running:
+            unfinished.add(column)
+            if colors[column] == "green":
+                colors[column] = "yellow"
+            messages[column] += "&yellow {} (in progress)\n".format(test["text"])
+            continue
+
+        record = results[index]
+        column_records[column].append((index, record))
+
+        if record["success"] and "slow" in record:
+            if colors[column] == "green":
+                colors[column] = "yellow"
+            messages[column] += "&yellow {} (slow: {:.1f}s, p95 {:.1f}s)\n".format(
+                test["text"], record["wall"], record["slow"]
+            )
+        elif record["success"]:
+            messages[column] += "&green " + test["text"] + "\n"
+        elif record.get("skipped") == "interrupted":
+            if colors[column] == "green":
+                colors[column] = "yellow"
+            messages[column] += "&yellow {} (run interrupted)\n".format(test["text"])
+        elif record.get("skipped"):
+            if colors[column] == "green":
+                colors[column] = "yellow"
+            messages[column] += "&yellow {} ({}: budget exceeded)\n".format(
+                test["text"], record["skipped"]
+            )
+        elif record.get("unreachable"):
+            colors[column] = "red"
+            messages[column] += "&red {} (host unreachable)\n".format(test["text"])
+        else:
+            colors[column] = "red"
+            messages[column] += "&red " + test["text"] + "\n"
+
+    for column in colors.keys():
+        for problem in problems:
+            messages[column] += "&yellow Invalid test skipped: " + problem + "\n"
+        if problems and colors[column] == "green":
+            colors[column] = "yellow"
+
+    command = "status" if lifetime is None else "status+{}".format(lifetime)
+    updates = []
+
+    for column in colors.keys():
+        status = "{} {}.{} {} {}\n{}".format(
+            command, machine, column, colors[column], xymonDate(), messages[column]
+        )
+        updates.append(status)
+
+        timings = timingData(column_records[column])
+        if column in unfinished or not timings:
+            continue
+
+        data = "data {}.{}{}\n{}".format(machine, column, DATA_SUFFIX, timings)
+        updates.append(data)
+
+    return updates
+
+
+# A machine whose test file has no valid tests at all has no columns to list
+# its problems in, so they turn its CONFIG_COLUMN yellow instead. Runs of
+# selected tests leave it alone, since they may have left out a machine's
+# valid tests.
+def configUpdates(tests, problems):
+    if test_selection is not None:
+        return []
+
+    updates = []
+    for machine, machine_problems in sorted(problems.items()):
+        if tests.get(machine):
+            continue
+
+        message = "".join(
+            "&yellow {}\n".format(problem) for problem in machine_problems
+        )
+        updates.append(
+            "status {}.{} yellow {}\n{}".format(
+                machine, CONFIG_COLUMN, xymonDate(), message
+            )
+        )
+    return updates
+
+
+def pagesOf(machine_tests):
+    pages = {}
+    for index, test in enumerate(machine_tests):
+        if test["type"] == "javascript":
+            pages.setdefault(pageKey(test), []).append(index)
+    return pages
+
+
+# Run every test once and send the results. This is what each Xymon task run
+# does. The run stops waiting for tests at RUN_DEADLINE, so it always
+# finishes within its Xymon INTERVAL; tests left over are reported as
+# skipped. The quickest tests go first so the fewest are left over. Each
+# column's status is sent as soon as its tests have finished, and if the run
+# dies, whatever finished is still sent.
+def runOnce(catalog):
+    run_start = time.time()
+    deadline = run_start + RUN_DEADLINE
+    run_records = []
+
+    tests, problems = catalog
+    reportProblems(problems)
+    try:
+        sendToXymon(configUpdates(tests, problems))
+    except OSError:
+        pass
+
+    rotation = currentRotation()
+    plan = {}
+    for machine in tests.keys():
+        plan[machine] = resolveTests(tests[machine], rotation)
+    alignCoords(tests, plan)
+
+    # Start every HTTP test up front so they run in the background while the
+    # browser works through the JavaScript tests below. Tests of the same URL
+    # (from any machine) run together on one fetch.
+    http_tests = []
+    for machine, machine_tests in plan.items():
+        for index, test in enumerate(machine_tests):
+            if test["type"] in httpTests:
+                http_tests.append((testBudget(test), machine, index))
+
+    url_groups = {}
+    for budget, machine, index in sorted(http_tests):
+        url = plan[machine][index]["url"]
+        url_groups.setdefault(url, []).append((machine, index))
+
+    # Each test's job, and its place among the results of the job.
+    http_results = {}
+    for members in url_groups.values():
+        group = [plan[machine][index] for machine, index in members]
+        host = urlparse(group[0]["url"]).hostname
+        future = submitHttp(host, runHttpTests, group, deadline)
+        for position, member in enumerate(members):
+            http_results[member] = (future, position)
+
+    # JavaScript tests that load the same page (and click the same element)
+    # share a single page load. Each machine's pages run on one browser worker.
+    browser_jobs = []
+    for machine, machine_tests in plan.items():
+        pages = pagesOf(machine_tests)
+        if pages:
+            budget = sum(
+                testBudget(machine_tests[index])
+                for indexes in pages.values()
+                for index in indexes
+            )
+            browser_jobs.append((budget, machine, pages))
+
+    browser_results = {}
+    browser_futures = []
+    for budget, machine, pages in sorted(browser_jobs, key=lambda job: job[:2]):
+        browser_results[machine] = {}
+        future = browser_pool.submit(
+            runPages, machine, plan[machine], pages, deadline, browser_results[machine]
+        )
+        browser_futures.append(future)
+
+    columns = {}
+    for machine, machine_tests in plan.items():
+        columns[machine] = {}
+        for index, test in enumerate(machine_tests):
+            columns[machine].setdefault(test["column"], []).append(index)
+
+    # The results in so far. Once the run is over (or has been interrupted),
+    # tests without one are marked "skipped". Tests of one URL share a job, so
+    # whether it was "not run" or "not finished" is decided once for all.
+    skipped_jobs = {}
+
+    def collectResults(machine, final=False, interrupted=False):
+        results = dict(browser_results.get(machine, {}))
+
+        for index, test in enumerate(plan[machine]):
+            future, position = http_results.get((machine, index), (None, 0))
+            if future is not None and future.done() and not future.cancelled():
+                try:
+                    results[index] = future.result()[position]
+                except Exception:
+                    results[index] = {"success": False, "wall": 0.0}
+            elif not final or index in results:
+                continue
+            elif interrupted:
+                if future is not None:
+                    future.cancel()
+                results[index] = {"success": False, "wall": 0.0}
+                results[index]["skipped"] = "interrupted"
+            elif future is not None:
+                if future not in skipped_jobs:
+                    cancelled = future.cancel()
+                    skipped_jobs[future] = "not run" if cancelled else "not finished"
+                skipped = skipped_jobs[future]
+                results[index] = {"success": False, "wall": 0.0, "skipped": skipped}
+            else:
+                results[index] = {"success": False, "wall": 0.0, "skipped": "not run"}
+
+        return results
+
+    # Send the status of every column whose tests have all finished, and,
+    # when a heartbeat is due, an "in progress" status for the rest.
+    sent = set()
+
+    def sendStatuses(heartbeat=False, final=False, interrupted=False):
+        updates = []
+
+        for machine, machine_tests in plan.items():
+            results = collectResults(machine, final, interrupted)
+            problems_of = problems.get(machine, ())
+
+            for column, indexes in columns[machine].items():
+                if (machine, column) in sent:
+                    continue
+
+                finished = {i: results[i] for i in indexes if i in results}
+                if len(finished) == len(indexes):
+                    sent.add((machine, column))
+                    for index, record in finished.items():
+                        annotateRecord(record, machine, machine_tests[index])
+                        checkLatency(record)
+                        run_records.append(record)
+                    updates.extend(
+                        statusUpdates(
+                            machine, machine_tests, finished, problems=problems_of
+                        )
+                    )
+                elif heartbeat:
+                    running = [i for i in indexes if i not in finished]
+                    updates.extend(
+                        statusUpdates(
+                            machine,
+                            machine_tests,
+                            finished,
+                            problems=problems_of,
+                            running=running,
+                        )
+                    )
+
+        if updates:
+            try:
+                sendToXymon(updates)
+            except OSError:
+                pass
+
+    pending = {future for future, position in http_results.values()}
+    pending |= set(browser_futures)
+    next_heartbeat = run_start + PROGRESS_INTERVAL
+    interrupted = True
+
+    try:
+        while pending:
+            left = remainingTime(deadline) + RUN_DEADLINE_GRACE
+            if left <= 0:
+                break
+
+            # Pages finish inside their machine's browser job, so check back
+            # every so often even if no job has finished.
+            pending = wait(
+                pending,
+                timeout=min(STATUS_CHECK_INTERVAL, left),
+                return_when=FIRST_COMPLETED,
+            )[1]
+
+            heartbeat = time.time() >= next_heartbeat
+            if heartbeat:
+                next_heartbeat += PROGRESS_INTERVAL
+            sendStatuses(heartbeat)
+
+        interrupted = False
+    finally:
+        # Whatever happened, report what has finished.
+        sendStatuses(final=True, interrupted=interrupted)
+        pruneCache()
+
+        run_time = time.time() - run_start
+        try:
+            writeRecords(run_records, run_start)
+        except OSError:
+            pass
+        # Ad-hoc runs of a few tests would throw off the usual latencies.
+        if send_statuses:
+            try:
+                storeHistory(run_records, run_start)
+            except sqlite3.Error:
+                pass
+        reportTimings(run_records, run_time)
+
+
+# Run one scheduling unit of the daemon: a single HTTP test, or the JavaScript
+# tests that share a page load. Returns the resolved tests and their records.
+def runUnit(machine, unit_tests):
+    unit_tests = resolveTests(unit_tests)
+
+    if unit_tests[0]["type"] == "javascript":
+        records = runPage(machine, unit_tests)
+    else:
+        records = runHttpTests(unit_tests)
+
+    return unit_tests, records
+
+
+def daemonUnits(tests):
+    units = []
+
+    for machine, machine_tests in tests.items():
+        for index, test in enumerate(machine_tests):
+            if test["type"] in httpTests:
+                units.append((machine, [index]))
+
+        for indexes in pagesOf(machine_tests).values():
+            units.append((machine, indexes))
+
+    return units
+
+
+def unitInterval(unit_tests):
+    intervals = []
+    for test in unit_tests:
+        intervals.append(test.get("interval", DAEMON_INTERVALS[test["type"]]))
+    return min(intervals)
+
+
+# Keep running, with each unit on its own interval. The browser workers and
+# HTTP connections stay open between runs. A unit that overruns its interval
+# runs again as soon as it finishes, never twice at once. When the test files
+# change, the schedule starts over with the new tests, but a unit whose URL
+# is still being tested from before waits for that to finish.
+def runDaemon(config_dir):
+    catalog = None
+    running = {}
+    generation = 0
+    next_config_check = 0
+    next_config_report = 0
+    prune_hour = None
+
+    while True:
+        now = time.time()
+
+        if now >= next_config_check:
+            next_config_check = now + CONFIG_CHECK_INTERVAL
+            new_catalog = selectTests(loadCatalog(config_dir))
+
+            if new_catalog is not catalog:
+                catalog = new_catalog
+                tests, problems = catalog
+                reportProblems(problems)
+                generation += 1
+
+                units = daemonUnits(tests)
+                intervals = [
+                    unitInterval([tests[machine][i] for i in indexes])
+                    for machine, indexes in units
+                ]
+
+                # Statuses stay valid for two of the longest intervals.
+                lifetime = 2 * max(intervals, default=0) // 60 + 1
+
+                busy = collections.Counter(key for *_, key in running.values())
+                waiting = {}
+                due = []
+                for unit, (machine, indexes) in enumerate(units):
+                    key = (machine, tests[machine][indexes[0]]["url"])
+                    if key in busy:
+                        waiting.setdefault(key, []).append(unit)
+                    else:
+                        due.append((now, unit))
+                heapq.heapify(due)
+                latest_tests = {machine: {} for machine in tests.keys()}
+                latest_results = {machine: {} for machine in tests.keys()}
+                next_config_report = now
+
+            # Sent again well before Xymon's default lifetime runs out.
+            if now >= next_config_report:
+                next_config_report = now + PROGRESS_INTERVAL
+                try:
+                    sendToXymon(configUpdates(tests, problems))
+                except OSError:
+                    pass
+
+        while due and due[0][0] <= now:
+            unit = heapq.heappop(due)[1]
+            machine, indexes = units[unit]
+            unit_tests = [tests[machine][i] for i in indexes]
+            if unit_tests[0]["type"] == "javascript":
+                future = browser_pool.submit(runUnit, machine, unit_tests)
+            else:
+                host = urlparse(unit_tests[0]["url"]).hostname
+                future = submitHttp(host, runUnit, machine, unit_tests)
+            running[future] = (generation, unit, now, (machine, unit_tests[0]["url"]))
+
+        timeout = next_config_check - time.time()
+        if due:
+            timeout = min(timeout, due[0][0] - time.time())
+        timeout = max(0, timeout)
+
+        if not running:
+            time.sleep(timeout)
+            continue
+
+        done = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)[0]
+
+        updates = []
+        records = []
+        finished_machines = set()
+
+        for future in done:
+            unit_generation, unit, started, key = running.pop(future)
+
+            # Results of tests from before the files changed are dropped, and
+            # the new units for the same URL can start.
+            if unit_generation != generation:
+                busy[key] -= 1
+                if busy[key] == 0:
+                    for waiting_unit in waiting.pop(key, []):
+                        heapq.heappush(due, (time.time(), waiting_unit))
+                continue
+
+            machine, indexes = units[unit]
+            heapq.heappush(due, (started + intervals[unit], unit))
+
+            try:
+                unit_tests, unit_records = future.result()
+            except Exception:
+                unit_tests = [tests[machine][i] for i in indexes]
+                unit_records = [{"success": False, "wall": 0.0} for i in indexes]
+
+            for index, test, record in zip(indexes, unit_tests, unit_records):
+                annotateRecord(record, machine, test)
+                checkLatency(record)
+                latest_tests[machine][index] = test
+                latest_results[machine][index] = record
+                records.append(record)
+
+            finished_machines.add(machine)
+
+        if not records:
+            continue
+
+        for machine in finished_machines:
+            machine_tests = [
+                latest_tests[machine].get(index, test)
+                for index, test in enumerate(tests[machine])
+            ]
+            updates.extend(
+                statusUpdates(
+                    machine,
+                    machine_tests,
+                    latest_results[machine],
+                    lifetime,
+                    problems.get(machine, ()),
+                )
+            )
+
+        try:
+            sendToXymon(updates)
+        except OSError:
+            pass
+
+        # One results file per hour, and the response cache is pruned as each
+        # one starts.
+        hour = now - now % 3600
+        try:
+            writeRecords(records, hour)
+        except OSError:
+            pass
+        if hour != prune_hour:
+            prune_hour = hour
+            pruneCache()
+        if send_statuses:
+            try:
+                storeHistory(records, now)
+            except sqlite3.Error:
+                pass
+
+
+def validateCatalog(config_dir):
+    tests, problems = loadCatalog(config_dir)
+    count = sum(len(machine_tests) for machine_tests in tests.values())
+
+    for machine_problems in problems.values():
+        for problem in machine_problems:
+            print(problem)
+
+    print("{} valid tests for {} machines.".format(count, len(tests)))
+    return 1 if problems else 0
+
+
+parser = argparse.ArgumentParser(description="Custom Xymon tests for SNAP web apps.")
+parser.add_argument(
+    "--daemon",
+    action="store_true",
+    help="keep running and schedule each test on its own interval",
+)
+parser.add_argument(
+    "--validate",
+    action="store_true",
+    help="check the test files and exit",
+)
+parser.add_argument(
+    "--rotation",
+    type=int,
+    help="use this point from each pool of coordinates, to replay a run",
+)
+parser.add_argument(
+    "--config",
+    default=CONFIG_DIR,
+    help="directory of test files (default: %(default)s)",
+)
+parser.add_argument(
+    "--host",
+    action="append",
+    help="only run the tests of this machine (can be repeated)",
+)
+parser.add_argument(
+    "--type",
+    action="append",
+    choices=TEST_TYPES,
+    help="only run tests of this type (can be repeated)",
+)
+parser.add_argument(
+    "--column",
+    action="append",
+    help="only run tests in this column (can be repeated)",
+)
+parser.add_argument(
+    "--send",
+    action="store_true",
+    help="send the statuses of selected tests to Xymon instead of printing them",
+)
+parser.add_argument(
+    "--trace",
+    action="store_true",
+    help="save a profile and network log of pages whose tests fail or are slow",
+)
+parser.add_argument(
+    "--percentiles",
+    type=float,
+    metavar="HOURS",
+    help="print latency percentiles of each test and host over the last HOURS",
+)
+parser.add_argument(
+    "pattern",
+    nargs="?",
+    help="only run tests whose text or URL matches this regular expression",
+)
+args = parser.parse_args()
+coord_rotation = args.rotation
+trace_pages = args.trace
+
+if args.host or args.type or args.column or args.pattern is not None:
+    test_selection = {
+        "hosts": args.host,
+        "types": args.type,
+        "columns": args.column,
+        "pattern": None,
+    }
+    if args.pattern is not None:
+        test_selection["pattern"] = re.compile(args.pattern, re.IGNORECASE)
+
+send_statuses = test_selection is None or args.send
+
+if args.validate:
+    sys.exit(validateCatalog(args.config))
+
+if args.percentiles is not None:
+    printPercentiles(args.percentiles)
+    sys.exit(0)
+
+# Prevent overlapping runs that send statuses with a lock file. Runs that only
+# print them can go ahead at any time.
+if send_statuses:
+    lock_fp = open(LOCKFILE, "w")
+    try:
+        fcntl.flock(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        sys.exit(0)  # another instance running — exit quietly
+
+
+# Exit normally on SIGTERM, so the results in so far are still sent.
+def terminate(signum, frame):
+    sys.exit(128 + signum)
+
+
+signal.signal(signal.SIGTERM, terminate)
+
+http_pool = ThreadPoolExecutor(max_workers=HTTP_WORKERS)
+browser_pool = ThreadPoolExecutor(max_workers=browserWorkerCount())
+
+try:
+    if args.daemon:
+        runDaemon(args.config)
+    else:
+        catalog = selectTests(loadCatalog(args.config))
+        if test_selection is not None and not catalog[0]:
+            sys.exit("No tests match the selection.")
+        runOnce(catalog)
+finally:
+    http_pool.shutdown()
+    browser_pool.shutdown()
 
+    for driver in list(drivers):
+        quitDriver(driver)